@@ -0,0 +1,294 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of PAWS on simulated hardware, for catching performance regressions on machines without a Phidgets board.
+
+Usage:
+    python benchmark.py [--protocol quick|representative] [--stress] [--save results.json] [--compare baseline.json] [--tolerance 0.25]
+
+Results are printed as JSON, as {metric: value}, all in seconds except for the CPU use (fraction of one core) and memory (in kB). With --compare, the script exits with an error if a metric is worse than in the baseline by more than the tolerance. It also exits with an error if a dry run requests the transitions of a sequence at other times than a real run does (see VirtualClock). Only medians are compared, as the tails are too noisy on shared machines.
+
+@author: Corentin Moevus cjm2206@columbia.edu
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function
+import time
+import os
+import sys
+import json
+import argparse
+import threading
+import socket
+import tempfile
+import subprocess
+from paws import PAWS, Pool, SimulatedHardware, Clock, VirtualClock, Report, Sequence, Block, monotonic
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Shutters used in the benchmarks: 10° moves of 1.8° steps motors.
+SHUTTER = {'step': 1.8, 'angle': 10, 'direction': False, 'state': True}
+
+# Protocols: number of shutters, wait between alternations and number of loops.
+PROTOCOLS = {
+    'quick': {'shutters': 4, 'wait': 0.1, 'loops': 100},
+    'representative': {'shutters': 4, 'wait': 0.1, 'loops': 10000},
+}
+
+# Number of moves for the switching benchmarks.
+MOVES = 50
+
+# Number of boards for the cross-board skew benchmark, the shutters of the protocol being spread over them.
+BOARDS = 2
+
+# Number of threads keeping the GIL busy, like a busy GUI, in the stress benchmark.
+STRESS_THREADS = 2
+
+# Number of interpreters started for the startup benchmark.
+STARTS = 10
+
+# Sequence of the dry run check: shutters switching while the others move, and the largest difference (in seconds) allowed between the times the transitions are requested in a dry run and in a real one.
+DRY_RUN = Sequence(dict([(i, Block([(0.2, False), (0.2, True)], repeat=3, offset=0.5 + 0.03 * i)) for i in range(4)]))
+DRY_RUN_TOLERANCE = 0.005
+
+# Differences under which metrics are not compared, as they are within the noise of a shared machine (seconds by default).
+NOISE = {'protocol.cpu': 0.02, 'protocol.memory': 1024, 'startup.import.p50': 0.01, 'startup.python.p50': 0.01}
+DEFAULT_NOISE = 0.002
+
+
+def get_memory():
+    """Return the peak memory used by the process, in kB, or None if it is unknown."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(name, values):
+    """Return the median, 99th percentile and maximum of <values>, as {name.statistic: value}."""
+    values = sorted(values)
+    return {name + '.p50': values[int(0.5 * (len(values) - 1))],
+            name + '.p99': values[int(0.99 * (len(values) - 1))],
+            name + '.max': values[-1]}
+
+
+def make_paws(shutters):
+    """Return a PAWS with <shutters> shutters on a simulated board."""
+    return PAWS(shutters=dict([(i, dict(SHUTTER)) for i in range(shutters)]), hardware=SimulatedHardware(motors=shutters))
+
+
+def bench_startup():
+    """Measure the time a new interpreter takes to start, and to start and import PAWS."""
+    results = dict()
+    for name, code in (('startup.python', 'pass'), ('startup.import', 'import paws')):
+        durations = list()
+        for i in range(STARTS):
+            t = monotonic()
+            subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+            durations.append(monotonic() - t)
+        results.update(summarize(name, durations))
+    return results
+
+
+def bench_switch(paws):
+    """Measure the latency and duration of single shutter switches."""
+    reports = [paws.set_states({0: not paws.shutters[0].state}) for i in range(MOVES)]
+    results = summarize('switch.latency', [r['latency'] for r in reports])
+    results.update(summarize('switch.duration', [r['duration'] for r in reports]))
+    return results
+
+
+def bench_skew(paws):
+    """Measure the skew between channels switched together."""
+    reports = [paws.switch_all() for i in range(MOVES)]
+    results = summarize('skew.command', [r['skew'] for r in reports])
+    results.update(summarize('skew.done', [r['done_skew'] for r in reports]))
+    return results
+
+
+def bench_boards(shutters, boards):
+    """Measure the skew between channels switched together, with the <shutters> spread over several simulated <boards>."""
+    motors = -(-shutters // boards)
+    pool = Pool([SimulatedHardware(motors=motors, serial=i) for i in range(boards)])
+    paws = PAWS(shutters=dict([(i, dict(SHUTTER)) for i in range(shutters)]), hardware=pool)
+    reports = [paws.switch_all() for i in range(MOVES)]
+    paws.close()
+    paws.todo.join(1)
+    paws.motion.join(1)
+    for board in pool.boards:
+        board.thread.join(1)
+    results = summarize('boards.skew.command', [r['skew'] for r in reports])
+    results.update(summarize('boards.skew.done', [r['done_skew'] for r in reports]))
+    return results
+
+
+def bench_control(paws):
+    """Measure the round trip of commands on the control socket: a PING, a SWITCH acknowledged as soon as it is requested, and one acknowledged once it is done."""
+    if hasattr(socket, 'AF_UNIX'):
+        address = os.path.join(tempfile.mkdtemp(), 'paws.sock')
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        address = '127.0.0.1:51062'
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    paws.start_server(address)
+    client.connect(address if hasattr(socket, 'AF_UNIX') else ('127.0.0.1', 51062))
+    replies = client.makefile('rb')
+
+    results = dict()
+    for name, command in (('control.ping', b'PING\n'), ('control.switch', b'SWITCH 0\n'), ('control.switch_wait', b'SWITCH 0 WAIT\n')):
+        durations = list()
+        for i in range(MOVES):
+            t = monotonic()
+            client.sendall(command)
+            replies.readline()
+            durations.append(monotonic() - t)
+            # Let the move be done before the next one
+            paws.wait(0.001)
+        results.update(summarize(name, durations))
+    client.close()
+    paws.server.stop()
+    paws.server = None
+    return results
+
+
+def bench_protocol(paws, loops, wait):
+    """Measure the scheduler lateness, CPU use and memory of a shuttering."""
+    paws.todo.timings.records.clear()
+    memory = get_memory()
+    cpu = sum(os.times()[:2])
+    t = monotonic()
+
+    # Start it
+    paws.shutter(loops, wait)
+    results = {'protocol.start': monotonic() - t}
+
+    # Wait for it to be done
+    while paws.get_progress()[0] < loops:
+        time.sleep(wait)
+    paws.motion.hold(paws.shutters.values(), False)
+    duration = monotonic() - t
+
+    results['protocol.cpu'] = (sum(os.times()[:2]) - cpu) / duration
+    if memory is not None:
+        results['protocol.memory'] = get_memory() - memory
+    results.update(summarize('protocol.lateness', paws.todo.timings.get('lateness')))
+    results.update(summarize('protocol.skew', paws.motion.timings.get('done_skew')))
+    return results
+
+
+def run_requested(clock, sequence):
+    """Run <sequence> on a simulated board with the <clock>, and return the times the transitions were requested, from the start, by shutter id."""
+    paws = PAWS(shutters=dict([(i, dict(SHUTTER)) for i in sequence.channels.keys()]), hardware=SimulatedHardware(motors=len(sequence.channels), clock=clock), clock=clock)
+    report = Report(paws.shutters, clock.now())
+    paws.motion.observers.append(report.record)
+    paws.run_sequence(sequence, clock.time())
+    paws.wait(0.001)
+    paws.close()
+    requested = dict()
+    for r, d, i, state in report.get_transitions():
+        requested.setdefault(i, list()).append(r)
+    return requested
+
+
+def bench_dry_run(sequence):
+    """Measure the difference between the times the transitions of <sequence> are requested in a dry run (see VirtualClock) and in a real one, on simulated boards."""
+    real, dry = run_requested(Clock(), sequence), run_requested(VirtualClock(), sequence)
+    errors = [abs(r - d) for i in real.keys() for r, d in zip(real[i], dry.get(i, list()))]
+    if sorted(real.keys()) != sorted(dry.keys()) or any([len(real[i]) != len(dry[i]) for i in real.keys()]):
+        errors.append(float('inf'))
+    return summarize('dryrun.error', errors)
+
+
+def busy(stop):
+    """Keep the GIL busy with Python code until <stop> is set, like a GUI redrawing."""
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def bench_stress(shutters, loops, wait):
+    """Measure the scheduler lateness of a shuttering while the process is busy, with PAWS in the same process and in a separate one (see process.py)."""
+    from process import PAWSProcess
+    results = dict()
+    for name in ('inprocess', 'isolated'):
+        if name == 'isolated':
+            paws = PAWSProcess(shutters=dict([(i, dict(SHUTTER)) for i in range(shutters)]), simulate=True)
+        else:
+            paws = make_paws(shutters)
+        stop = threading.Event()
+        threads = [threading.Thread(target=busy, args=(stop, )) for i in range(STRESS_THREADS)]
+        for thread in threads:
+            thread.start()
+
+        paws.shutter(loops, wait)
+        while paws.get_progress()[0] < loops:
+            time.sleep(wait)
+        lateness = paws.get_timings()['scheduler']['lateness']
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+        paws.close()
+        if name == 'inprocess':
+            paws.todo.join(1)
+            paws.motion.join(1)
+            paws.hardware.thread.join(1)
+        for statistic in ('p50', 'p99', 'max'):
+            results['stress.{0}.lateness.{1}'.format(name, statistic)] = lateness[statistic]
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the metrics of <results> worse than in <baseline> by more than <tolerance> (relative) and than the noise, as {metric: (baseline, result)}. Percentiles other than the median are not compared."""
+    worse = dict()
+    for metric, value in results.items():
+        if metric.endswith('.p99') or metric.endswith('.max'):
+            continue
+        noise = NOISE.get(metric, DEFAULT_NOISE)
+        if metric in baseline and value > baseline[metric] * (1 + tolerance) + noise:
+            worse[metric] = (baseline[metric], value)
+    return worse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark PAWS on simulated hardware.")
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS.keys()), default='quick')
+    parser.add_argument('--stress', action='store_true', help="also measure the scheduler lateness under load, with and without a separate motion process")
+    parser.add_argument('--save', help="file to save the results in")
+    parser.add_argument('--compare', help="results of a previous run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative tolerance on the comparison")
+    args = parser.parse_args()
+
+    protocol = PROTOCOLS[args.protocol]
+    paws = make_paws(protocol['shutters'])
+    results = bench_startup()
+    results.update(bench_switch(paws))
+    results.update(bench_skew(paws))
+    results.update(bench_boards(protocol['shutters'], BOARDS))
+    results.update(bench_control(paws))
+    results.update(bench_protocol(paws, protocol['loops'], protocol['wait']))
+    results.update(bench_dry_run(DRY_RUN))
+    paws.close()
+    paws.todo.join(1)
+    paws.motion.join(1)
+    paws.hardware.thread.join(1)
+    if args.stress:
+        results.update(bench_stress(protocol['shutters'], protocol['loops'], protocol['wait']))
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            worse = compare(results, json.load(f), args.tolerance)
+        for metric, (before, after) in sorted(worse.items()):
+            print("Regression: {0} went from {1:.6f} to {2:.6f}".format(metric, before, after))
+        if len(worse) > 0:
+            exit(1)
+
+    # Dry runs are what protocols are checked with: they must be right, whatever the baseline.
+    if results['dryrun.error.max'] > DRY_RUN_TOLERANCE:
+        print("Dry run: transitions requested {0:.6f}s away from the real run.".format(results['dryrun.error.max']))
+        exit(1)
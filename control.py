@@ -0,0 +1,232 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Control socket of PAWS, for driving the shutters from other programs, such as acquisition software.
+
+Clients connect to a Unix domain socket, or to a TCP port on localhost, and send commands, one per line. Each command gets one reply line. Several clients can be connected at once. Each one is served by its own thread, and the moves are done by the MotionController, so a slow client does not delay the shutters.
+
+Commands (case-insensitive):
+    PING: reply "PONG".
+    GET: reply "STATE <id>=<state> ...", states being 1 for closed and 0 for open, like Shutter.state.
+    SET <id>=<state> ... [WAIT]: set the shutters in the given states (0 or 1) at once (see PAWS.set_states).
+    SWITCH [<id> ...] [WAIT]: switch the given shutters at once, all of them if none are given.
+    SUB: also send "EVENT <time> <id> <state>" lines each time a shutter is done switching, time being in seconds since the epoch.
+    UNSUB: stop sending the transitions.
+
+Replies are "OK" as soon as the move is requested, or "OK <latency> <duration>" (in seconds, see Move.report) once it is done if WAIT is given, and "ERR <message>" if the command could not be done.
+
+@author: Corentin Moevus cjm2206@columbia.edu
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function
+import os
+import socket
+import logging
+import threading
+import SocketServer
+from Queue import Queue, Full
+
+logger = logging.getLogger('paws')
+
+
+def is_loopback(host, port):
+    """Return whether all the addresses of <host> are loopback addresses."""
+    try:
+        addresses = [a[4][0] for a in socket.getaddrinfo(host, port)]
+    except socket.gaierror:
+        return False
+    return len(addresses) > 0 and all([a.startswith('127.') or a == '::1' for a in addresses])
+
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix domain socket server, with one thread per client."""
+    daemon_threads = True
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """TCP server, with one thread per client."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+    """Connection of one client: read its commands and write the replies and the transitions it subscribed to."""
+
+    def setup(self):
+        """Prepare the connection."""
+        SocketServer.StreamRequestHandler.setup(self)
+        if self.connection.family != getattr(socket, 'AF_UNIX', None):
+            # Send the replies at once, instead of waiting for more to send.
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        self.events = None
+
+    def handle(self):
+        """Reply to the commands until the client is gone."""
+        control = self.server.control
+        for line in iter(self.rfile.readline, b''):
+            words = line.decode('ascii', 'replace').split()
+            if len(words) == 0:
+                continue
+            command = words[0].upper()
+            if command == 'SUB':
+                reply = self.subscribe()
+            elif command == 'UNSUB':
+                reply = self.unsubscribe()
+            else:
+                reply = control.execute(command, words[1:])
+            self.send(reply)
+
+    def finish(self):
+        """Forget the client."""
+        self.unsubscribe()
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def send(self, line):
+        """Send <line> to the client."""
+        with self.lock:
+            self.wfile.write(line.encode('ascii') + b'\n')
+            self.wfile.flush()
+
+    def subscribe(self):
+        """Send the transitions to the client, from a thread of their own."""
+        if self.events is None:
+            self.events = Queue(self.server.control.backlog)
+            sender = threading.Thread(target=self.send_events, args=(self.events, ))
+            sender.daemon = True
+            sender.start()
+            self.server.control.subscribe(self.events)
+        return 'OK'
+
+    def unsubscribe(self):
+        """Stop sending the transitions to the client."""
+        if self.events is not None:
+            self.server.control.unsubscribe(self.events)
+            try:
+                self.events.put_nowait(None)
+            except Full:
+                # The client does not read its transitions: drop them, rather than waiting for room for the end of the queue.
+                with self.events.mutex:
+                    self.events.queue.clear()
+                self.events.put_nowait(None)
+            self.events = None
+        return 'OK'
+
+    def send_events(self, events):
+        """Send the transitions from the queue <events> to the client, until None is found."""
+        for event in iter(events.get, None):
+            try:
+                self.send('EVENT {0:.6f} {1} {2:d}'.format(*event))
+            except socket.error:
+                return
+
+
+class ControlServer(object):
+    """
+    Serve the control socket of a PAWS (see the module's documentation for the protocol).
+
+    Arguments:
+        paws <PAWS>: PAWS to control
+        address <str>: path of the Unix domain socket, or "port" for TCP on localhost, or "host:port" for TCP on another loopback address. Other hosts are refused, as there is no authentication.
+        backlog <int>: number of transitions kept for a subscribed client that does not read them fast enough. Later ones are dropped. Defaults to 1000.
+    """
+
+    def __init__(self, paws, address, backlog=1000):
+        """Open the socket and serve it from a thread."""
+        self.paws, self.address, self.backlog = paws, address, backlog
+        self.subscribers = list()
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+        self.unix = not address.isdigit() and ':' not in address
+        if self.unix is False:
+            host, port = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+            if not is_loopback(host, int(port)):
+                raise ValueError("The control socket is only served on localhost, not on {0}: it has no authentication.".format(host))
+            self.server = ThreadingTCPServer((host, int(port)), ControlHandler)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = ThreadingUnixStreamServer(address, ControlHandler)
+        self.server.control = self
+
+        # Listen to the transitions
+        self.paws.motion.observers.append(self.notify)
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def execute(self, command, arguments):
+        """Do the <command> with its <arguments> (list of strings), and return the reply."""
+        shutters = self.paws.shutters if self.paws.shutters is not None else dict()
+        try:
+            wait = len(arguments) > 0 and arguments[-1].upper() == 'WAIT'
+            if wait:
+                arguments = arguments[:-1]
+            if command == 'PING':
+                return 'PONG'
+            elif command == 'GET':
+                return ' '.join(['STATE'] + ['{0}={1:d}'.format(i, s.state) for i, s in sorted(shutters.items())])
+            elif command == 'SET':
+                states = [argument.split('=') for argument in arguments]
+                if any([state not in ('0', '1') for i, state in states]):
+                    return 'ERR states must be 0 or 1'
+                states = dict([(int(i), state == '1') for i, state in states])
+            elif command == 'SWITCH':
+                ids = [int(i) for i in arguments] if len(arguments) > 0 else shutters.keys()
+            else:
+                return 'ERR unknown command {0}'.format(command)
+        except ValueError:
+            return 'ERR wrong arguments'
+        unknown = [i for i in (ids if command == 'SWITCH' else states.keys()) if i not in shutters]
+        if len(unknown) > 0:
+            return 'ERR no shutters {0}'.format(' '.join([str(i) for i in unknown]))
+
+        # Switches are counted from the state the shutters are switching to, so that a switch sent while the previous one is in progress is done too.
+        if command == 'SWITCH':
+            move = self.paws.switch(ids, wait=False)
+        else:
+            move = self.paws.set_states(states, wait=False)
+        if wait is False:
+            return 'OK'
+        move.wait()
+        if move.error is not None:
+            return 'ERR {0}'.format(move.error)
+        report = move.report()
+        if report['duration'] is None:
+            return 'OK 0 0'
+        return 'OK {0:.6f} {1:.6f}'.format(report['latency'], report['duration'])
+
+    def notify(self, shutter, move):
+        """Give the transition of <shutter> done by <move> to the subscribed clients. Called by the MotionController, so it must not block."""
+        clock = self.paws.clock
+        event = (clock.time() - clock.now() + move.done[shutter.id], shutter.id, shutter.state)
+        with self.lock:
+            for events in self.subscribers:
+                try:
+                    events.put_nowait(event)
+                except Full:
+                    self.dropped += 1
+
+    def subscribe(self, events):
+        """Put the transitions in the queue <events>."""
+        with self.lock:
+            self.subscribers.append(events)
+
+    def unsubscribe(self, events):
+        """Stop putting the transitions in the queue <events>."""
+        with self.lock:
+            if events in self.subscribers:
+                self.subscribers.remove(events)
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        if self.notify in self.paws.motion.observers:
+            self.paws.motion.observers.remove(self.notify)
+        self.server.shutdown()
+        self.server.server_close()
+        if self.unix is True and os.path.exists(self.address):
+            os.unlink(self.address)
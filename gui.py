@@ -0,0 +1,436 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Graphical interface of PAWS.
+
+It is only imported by PAWS.start_gui, so that PAWS can be used without GTK nor a display.
+
+@author: Corentin Moevus cjm2206@columbia.edu
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function
+from math import ceil
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk, Gdk, GLib
+
+
+class GUI(Gtk.Builder):
+    """Graphical User Interface for interacting with a PAWS."""
+
+    #
+    # GUI related methods
+    #
+    def __init__(self, paws, gui_file="GUI.glade", *args):
+        """Initiate the parent objects and do basic definitions."""
+        # Connect the GUI to handlers
+        Gtk.Builder.__init__(self)
+        self.add_from_file(gui_file)
+        self.connect_signals(self)
+
+        # Connect to PAWS
+        self.paws = paws
+
+        # Time (in seconds) between two updates of the progress
+        self.update_frequency = 0.1
+
+        # Timer updating the progress, and whether a refresh of the switches is waiting for the main loop
+        self.progress_timer = None
+        self.refresh_pending = False
+
+    def show_settings_if_need_be(self):
+        """Decide whether to show the Settings panel at start."""
+        if self.paws.shutters is None:
+            self.get_object('settings_window').show_all()
+
+    def start(self):
+        """Start the GUI."""
+        # No Hardware, no GUI.
+        if self.paws.hardware is None:
+            window = self.get_object('no_hardware')
+            window.show_all()
+        else:
+            window = self.get_object('paws')
+            self.add_shutter_widgets()
+            window.show_all()
+            self.update_gui_settings()
+            self.show_settings_if_need_be()
+            self.load_shuttering_parameters()
+            self.update_queue()
+
+        Gtk.main()
+
+    def close(self, *args):
+        """Stop the GUI."""
+        self.save_shuttering_parameters()
+        self.paws.gui = None
+        Gtk.main_quit(*args)
+
+    #
+    # Shuttering related methods
+    #
+    def get_shuttering_parameters(self):
+        """Return the shuttering parameters from the GUI."""
+        loops = self.get_object("loops").get_value()
+        loops_units = self.get_object("loops_units").get_active()
+        wait = self.get_object("wait").get_value()
+        wait_units = self.get_object("wait_units").get_active()
+        return loops, loops_units, wait, wait_units
+
+    def get_converted_shuttering_parameters(self):
+        """Get the shuttering parameters from the GUI and return them in loops and seconds for the PAWS.shutter() function."""
+        loops, loops_u, wait, wait_u = self.get_shuttering_parameters()
+        convert = {0: 1, 1: 60, 2: 60**2}
+        wait = wait * convert[wait_u]
+        if loops_u != 0:
+            loops = ceil(loops * convert[loops_u - 1] / wait)
+        loops = int(loops)
+        return loops, wait
+
+    def start_shutter(self, *args):
+        """Start shuttering via GUI."""
+        self.get_object("shutter_stop").show()
+        self.get_object("shutter_back").hide()
+        self.show_shutter_progress()
+        self.loops, self.wait = self.get_converted_shuttering_parameters()
+        self.paws.shutter(self.loops, self.wait)
+        self.start_progress_timer()
+
+    def stop_shutter(self, *args):
+        """Stop shuttering via GUI."""
+        self.paws.stop_shutter()
+        self.stop_progress_timer()
+        self.loops = None
+        self.wait = None
+        self.get_object("shutter_stop").hide()
+        self.get_object("shutter_back").show()
+
+    def show_shutter_parameters(self, *args):
+        """Go to the shuttering parameters panel."""
+        self.update_queue()
+        self.get_object("shutter").set_visible_child_name('parameters')
+
+    def show_shutter_progress(self, *args):
+        """Go to the shuttering progress panel."""
+        self.get_object("shutter").set_visible_child_name('progress')
+
+    def get_refresh_rate(self):
+        """Return the refresh rate (in Hz) of the display showing PAWS, or 60 if it is unknown."""
+        try:
+            window = self.get_object('paws').get_window()
+            rate = Gdk.Display.get_default().get_monitor_at_window(window).get_refresh_rate() / 1000
+        except (AttributeError, TypeError):
+            rate = 0
+        return rate if rate > 0 else 60
+
+    def start_progress_timer(self):
+        """Update the progress every update_frequency seconds, but not faster than the display can show it."""
+        self.stop_progress_timer()
+        interval = max(self.update_frequency, 1 / self.get_refresh_rate())
+        self.progress_timer = GLib.timeout_add(int(interval * 1000), self.update_shuttering_progress)
+        self.update_shuttering_progress()
+
+    def stop_progress_timer(self):
+        """Stop updating the progress."""
+        if self.progress_timer is not None:
+            GLib.source_remove(self.progress_timer)
+            self.progress_timer = None
+
+    def update_shuttering_progress(self):
+        """Update the progress bars with the progress of the shuttering, or of the queue of protocols. Return whether to keep updating them (for the GLib timer)."""
+        progress = self.paws.get_progress()
+        running, protocols = self.paws.get_queue()
+        if progress is None:
+            if running is True:
+                # A queued sequence is in progress.
+                self.get_object('progress_loops').set_text("Sequence, {0} protocols left in the queue".format(len(protocols)))
+                self.get_object('progress_wait').set_text("")
+                return True
+
+            # The queue is done, after a sequence.
+            self.get_object('progress_loops').set_fraction(1)
+            self.get_object('progress_loops').set_text("Done.")
+            self.get_object('progress_wait').set_fraction(1)
+            self.get_object('progress_wait').set_text("")
+            self.get_object("shutter_stop").hide()
+            self.get_object("shutter_back").show()
+            self.progress_timer = None
+            return False
+        loop, t = progress
+
+        # The queue may have moved on to another shuttering.
+        if self.paws.shuttering is not None:
+            self.loops, self.wait = self.paws.shuttering[1:]
+
+        # Adjust text.
+        loops_text = "Alternation {0}/{1}".format(loop, self.loops)
+        wait_text = "{0:.1f} seconds before next alternation".format(self.wait - t)
+
+        # Shuttering is done?
+        done = loop == self.loops and running is False
+        if done:
+            wait_text = "Done."
+            loops_text = "Done. ({0}/{1})".format(loop, self.loops)
+            self.get_object("shutter_stop").hide()
+            self.get_object("shutter_back").show()
+            self.progress_timer = None
+
+        # Show it (we're in the GTK main loop, here.)
+        self.get_object('progress_loops').set_fraction(loop / self.loops)
+        self.get_object('progress_loops').set_text(loops_text)
+        self.get_object('progress_wait').set_fraction(t / self.wait)
+        self.get_object('progress_wait').set_text(wait_text)
+        return not done
+
+    #
+    # Queue related methods
+    #
+    def queue_shutter(self, *args):
+        """Add a shuttering with the parameters of the GUI to the queue of protocols."""
+        loops, wait = self.get_converted_shuttering_parameters()
+        self.paws.queue_shutter(loops, wait)
+        self.update_queue()
+
+    def start_queue(self, *args):
+        """Run the queued protocols, one after the other."""
+        self.get_object("shutter_stop").show()
+        self.get_object("shutter_back").hide()
+        self.show_shutter_progress()
+        self.paws.run_queue()
+        self.start_progress_timer()
+
+    def clear_queue(self, *args):
+        """Remove the protocols waiting in the queue."""
+        self.paws.clear_queue()
+        self.update_queue()
+
+    def update_queue(self):
+        """Show the protocols waiting in the queue."""
+        lines = list()
+        for k, protocol in enumerate(self.paws.get_queue()[1]):
+            if protocol[0] == 'shutter':
+                lines.append("{0}. {1} alternations every {2:g} seconds".format(k + 1, protocol[1], protocol[2]))
+            else:
+                lines.append("{0}. Sequence of {1:g} seconds".format(k + 1, protocol[1].get_duration()))
+        self.get_object('queue').set_text("\n".join(lines) if len(lines) > 0 else "Empty.")
+
+    def save_shuttering_parameters(self):
+        """Save the shuttering parameters in the PAWS object."""
+        if 'gui_settings' not in vars(self.paws):
+            self.paws.gui_settings = dict()
+        self.paws.gui_settings['shuttering'] = self.get_shuttering_parameters()
+
+    def load_shuttering_parameters(self):
+        """Load shuttering parameters saved in the PAWS object."""
+        if 'gui_settings' in vars(self.paws) and 'shuttering' in self.paws.gui_settings.keys():
+            loops, loops_u, wait, wait_u = self.paws.gui_settings['shuttering']
+            self.get_object('loops').set_value(loops)
+            self.get_object('loops_units').set_active(loops_u)
+            self.get_object('wait').set_value(wait)
+            self.get_object('wait_units').set_active(wait_u)
+
+    #
+    # Settings related methods
+    #
+    def show_settings(self, *args):
+        """Open the settings window."""
+        self.update_timings()
+        self.get_object('settings_window').show()
+
+    def update_timings(self, *args):
+        """Show the timings of the scheduler and the shutters in the settings window."""
+        def line(name, summary):
+            if summary['count'] == 0:
+                return "{0}: -".format(name)
+            return "{0}: p50 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms".format(name, summary['p50'] * 1000, summary['p99'] * 1000, summary['max'] * 1000)
+
+        timings = self.paws.get_timings()
+        lines = ["<b>Timings</b>",
+                 line("Clock lateness", timings['scheduler']['lateness']),
+                 line("Clock tasks duration", timings['scheduler']['duration']),
+                 line("Shutters skew", timings['moves']['done_skew'])]
+        for i, shutter in timings['shutters'].items():
+            name = self.paws.gui_settings['shutter_names'].get(i, i) if 'gui_settings' in vars(self.paws) else i
+            lines.append(line("Shutter {0} move".format(name), shutter['move']))
+            lines.append(line("Shutter {0} engage/disengage".format(name), shutter['engage']))
+        self.get_object('timings').set_markup("\n".join(lines))
+
+    def close_settings(self, *args):
+        """Close the settings window."""
+        self.get_object('settings_window').hide()
+
+    def get_shutter_settings_widgets(self, i):
+        """Return widgets for shutter <i>."""
+        settings = self.get_object("settings_shutters")
+        widgets = {
+            'active': settings.get_child_at(i + 1, 1),
+            'name': settings.get_child_at(i + 1, 2),
+            'step': settings.get_child_at(i + 1, 3),
+            'angle': settings.get_child_at(i + 1, 4),
+            'direction': settings.get_child_at(i + 1, 5),
+            'state': settings.get_child_at(i + 1, 6),
+        }
+        return widgets
+
+    def add_shutter_widgets(self):
+        """Add settings and a switch for the motors GUI.glade has no widgets for, such as the ones of the boards of a Pool after the first one, like the ones of motor 0."""
+        settings, switches = self.get_object("settings_shutters"), self.get_object("switches")
+        first = self.get_shutter_settings_widgets(0)
+
+        def spin(widget):
+            """Return a SpinButton like <widget>, with an Adjustment of its own."""
+            a = widget.get_adjustment()
+            adjustment = Gtk.Adjustment(a.get_value(), a.get_lower(), a.get_upper(), a.get_step_increment(), a.get_page_increment(), a.get_page_size())
+            return Gtk.SpinButton(adjustment=adjustment, digits=widget.get_digits(), max_width_chars=3, valign=Gtk.Align.CENTER)
+
+        for i in range(self.paws.hardware.getMotorCount()):
+            if settings.get_child_at(i + 1, 1) is not None:
+                continue
+
+            # Settings
+            active = Gtk.Switch(active=True, valign=Gtk.Align.CENTER)
+            active.connect('notify::active', self.switch_shutter_settings_widgets)
+            name = Gtk.Entry(text=str(i), has_frame=False, width_chars=10, max_width_chars=15, halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER)
+            column = [Gtk.Label(label=str(i)), active, name, spin(first['step']), spin(first['angle']), Gtk.Switch(valign=Gtk.Align.CENTER), Gtk.Switch(valign=Gtk.Align.CENTER)]
+            for row, widget in enumerate(column):
+                settings.attach(widget, i + 1, row, 1, 1)
+
+            # Switch
+            box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+            switch = Gtk.Switch()
+            switch.connect('button-release-event', self.switch_shutter_state)
+            box.pack_start(Gtk.Label(label="Shutter {0}".format(i)), False, True, 0)
+            box.pack_start(switch, False, True, 0)
+            switches.attach(box, i, 0, 1, 1)
+
+    def switch_shutter_settings_widgets(self, *args):
+        """Hide/Show the settings for the given shutter."""
+        active = args[0].get_active()
+        widgets = self.get_shutter_settings_widgets(self.get_object("settings_shutters").child_get_property(args[0], 'left-attach') - 1)
+        for k, v in widgets.items():
+            if k != 'active':
+                if active:
+                    v.show()
+                else:
+                    v.hide()
+
+    def update_paws_settings(self, *args):
+        """Update the settings in PAWS using the settings in the GUI."""
+        # Update general settings
+        self.update_frequency = self.get_object('update_frequency').get_value()
+        self.paws.todo.precision = self.get_object('precision').get_value()
+
+        # Put the GUI-specific settings in the PAWS object for saving them.
+        self.paws.gui_settings = {
+            'update_frequency': self.update_frequency,
+            'shutter_names': dict([(i, str(i)) for i in range(self.paws.hardware.getMotorCount())]) if self.paws.hardware is not None else dict()
+        }
+
+        # Update Shutters settings
+        shutters = dict()
+        if self.paws.hardware is not None:
+            for i in range(self.paws.hardware.getMotorCount()):
+                widgets = self.get_shutter_settings_widgets(i)
+                if widgets['active'].get_active() == True:
+                    # Keep the settings that are not in the GUI
+                    if self.paws.shutters is not None and i in self.paws.shutters.keys():
+                        shutters[i] = self.paws.shutters[i].get_settings()
+                    else:
+                        shutters[i] = dict()
+                    shutters[i]['step'] = widgets['step'].get_value()
+                    shutters[i]['angle'] = widgets['angle'].get_value()
+                    shutters[i]['direction'] = widgets['direction'].get_active()
+                    shutters[i]['state'] = widgets['state'].get_active()
+                    self.paws.gui_settings["shutter_names"][i] = widgets['name'].get_text()
+        if len(shutters) == 0:
+            shutters = None
+        self.paws.setup_shutters(shutters)
+
+        # Update switches
+        self.pair_shutter_switches()
+
+    def update_gui_settings(self, *args):
+        """Update the settings in the GUI using the settings from PAWS."""
+        # Update Shutters settings
+        if self.paws.shutters is not None:
+            for i in range(self.paws.hardware.getMotorCount()):
+                widgets = self.get_shutter_settings_widgets(i)
+                if i in self.paws.shutters.keys():
+                    shutter = self.paws.shutters[i]
+                    widgets['step'].set_value(shutter.step)
+                    widgets['angle'].set_value(shutter.angle)
+                    widgets['direction'].set_active(shutter.direction)
+                    widgets['state'].set_active(shutter.state)
+                    widgets['name'].set_text(self.paws.gui_settings['shutter_names'].get(i, str(i)))
+                else:
+                    widgets['active'].set_active(False)
+
+        # Update switches
+        self.pair_shutter_switches()
+
+        # Load the GUI-specific settings from the PAWS object
+        if 'gui_settings' in vars(self.paws):
+            self.update_frequency = self.paws.gui_settings['update_frequency']
+
+        # Update the general settings
+        self.get_object('update_frequency').set_value(self.update_frequency)
+        self.get_object('precision').set_value(self.paws.todo.precision)
+
+    #
+    # Shutter switches related methods
+    #
+    def get_shutter_switch(self, i):
+        """Return widgets for shutter <i>."""
+        return self.get_object("switches").get_child_at(i, 0).get_children()[1]
+
+    def get_shutter_switchbox(self, i):
+        """Return the Box containing Switch and Label of shutter <i>."""
+        return self.get_object("switches").get_child_at(i, 0)
+
+    def switch_shutter_state(self, *args):
+        """Switch the physical state of a shutter from a GUI call."""
+        for i, s in self.paws.shutters.items():
+            if self.get_shutter_switch(i) == args[0]:
+                s.activate()
+
+    def shutter_switched(self, shutter):
+        """Refresh the switches once the GTK main loop is idle (called from the MotionController thread). Only one refresh is ever waiting."""
+        if self.refresh_pending is False:
+            self.refresh_pending = True
+            GLib.idle_add(self.refresh_switches)
+
+    def refresh_switches(self):
+        """Set the switches in the state of their shutter."""
+        self.refresh_pending = False
+        if self.paws.shutters is not None:
+            for i, shutter in self.paws.shutters.items():
+                self.get_shutter_switch(i).set_active(shutter.state)
+        return False
+
+    def pair_shutter_switches(self):
+        """Update the switches to match current settings and associate the GUI to the shutters."""
+        if self.paws.shutters is not None:
+            self.get_object('switches').show()
+            self.get_object('no_shutters').hide()
+            for i in range(self.paws.hardware.getMotorCount()):
+                if i in self.paws.shutters.keys():
+                    shutter = self.paws.shutters[i]
+                    switch = self.get_shutter_switch(i)
+                    box = self.get_shutter_switchbox(i)
+
+                    # Switch visibility
+                    box.show()
+                    switch.set_active(shutter.state)
+
+                    # Add GUI to the shutter
+                    shutter.gui = self
+
+                    # Setup the shutter's name
+                    box.get_children()[0].set_text(self.get_shutter_settings_widgets(i)['name'].get_text())
+
+                    # Sync state
+                    switch.set_state(shutter.state)
+                else:
+                    self.get_shutter_switchbox(i).hide()
+        else:
+            self.get_object('switches').hide()
+            self.get_object('no_shutters').show()
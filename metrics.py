@@ -0,0 +1,185 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+Metrics of PAWS, served over HTTP in the text format of Prometheus, for monitoring.
+
+GET /metrics returns:
+    paws_scheduler_queue_depth: number of events waiting in the TimeKeeper
+    paws_scheduler_lateness_seconds: histogram of the lateness of the events of the TimeKeeper
+    paws_shutter_switches_total: number of switches done by each shutter
+    paws_shutter_move_seconds: histogram of the time each shutter takes to reach its target
+    paws_shutter_state: state of each shutter, 1 for closed and 0 for open
+    paws_usb_calls_total: number of calls to each board, by method (see Board)
+    paws_shuttering_loops, paws_shuttering_loops_done: alternations of the shuttering in progress, and done
+    paws_queue_protocols: number of protocols waiting in the queue (see PAWS.run_queue)
+    paws_run_overruns, paws_run_skipped: late events of the runs in progress or last done (see Run.report)
+
+The histograms are fed by the TimeKeeper and the MotionController as they go, and the rest is read when the metrics are asked for, without locking PAWS, so that serving them never delays the shutters. Each request is served by its own thread.
+
+@author: Corentin Moevus cjm2206@columbia.edu
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+from bisect import bisect_left
+
+logger = logging.getLogger('paws')
+
+# Upper bounds of the buckets of the histograms, in seconds.
+LATENESS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+MOVE_BUCKETS = (0.01, 0.02, 0.05, 0.075, 0.1, 0.2, 0.5, 1, 2)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values, as in Prometheus.
+
+    Arguments:
+        buckets <tuple>: upper bounds of the buckets, sorted
+    """
+
+    def __init__(self, buckets):
+        """Start with no values."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Count <value> in its bucket."""
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def render(self, name, labels=''):
+        """Return the lines of the histogram, as metric <name> with <labels> ('key="value",...')."""
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = list()
+        count = 0
+        for bound, n in zip(self.buckets + ('+Inf', ), counts):
+            count += n
+            lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(name, labels + ',' if labels else '', bound, count))
+        lines.append('{0}_sum{1} {2!r}'.format(name, '{' + labels + '}' if labels else '', total))
+        lines.append('{0}_count{1} {2}'.format(name, '{' + labels + '}' if labels else '', count))
+        return lines
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server, with one thread per request."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request for the metrics."""
+
+    def do_GET(self):
+        """Send the metrics, at /metrics only."""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log the requests at the debug level, rather than on stderr."""
+        logger.debug('Metrics: ' + format, *args)
+
+
+class MetricsServer(object):
+    """
+    Serve the metrics of a PAWS (see the module's documentation).
+
+    Arguments:
+        paws <PAWS>: PAWS to monitor
+        address <str>: "port", on localhost, or "host:port". There is no authentication.
+    """
+
+    def __init__(self, paws, address):
+        """Listen to PAWS and serve the metrics from a thread."""
+        self.paws = paws
+        host, port = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+        self.lateness = Histogram(LATENESS_BUCKETS)
+        self.moves = dict()
+
+        # Feed the histograms
+        self.paws.todo.timings.observers.append(self.scheduled)
+        self.paws.motion.observers.append(self.transition)
+
+        self.server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+        self.server.metrics = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def scheduled(self, scheduled, dispatched, lateness, duration):
+        """Count the lateness of an event of the TimeKeeper. Called by the TimeKeeper, so it must not block."""
+        self.lateness.observe(lateness)
+
+    def transition(self, shutter, move):
+        """Count the transition of <shutter> done by <move>. Called by the MotionController, so it must not block."""
+        if shutter.id not in self.moves:
+            self.moves[shutter.id] = Histogram(MOVE_BUCKETS)
+        done = move.done[shutter.id]
+        self.moves[shutter.id].observe(done - move.started.get(shutter.id, done))
+
+    def render(self):
+        """Return the metrics, in the text format of Prometheus."""
+        paws = self.paws
+        lines = list()
+
+        def metric(name, kind, description, values):
+            """Add the lines of a metric, with its <values> as (labels, value) tuples."""
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in values:
+                lines.append('{0}{1} {2}'.format(name, '{' + labels + '}' if labels else '', value))
+
+        # Scheduler
+        metric('paws_scheduler_queue_depth', 'gauge', 'Events waiting in the TimeKeeper.', [('', len(paws.todo.queue) - paws.todo.stale)])
+        metric('paws_scheduler_lateness_seconds', 'histogram', 'Lateness of the events of the TimeKeeper.', [])
+        lines.extend(self.lateness.render('paws_scheduler_lateness_seconds'))
+
+        # Shutters
+        moves = sorted(self.moves.items())
+        metric('paws_shutter_switches_total', 'counter', 'Switches done by each shutter.', [('shutter="{0}"'.format(i), sum(h.counts)) for i, h in moves])
+        metric('paws_shutter_move_seconds', 'histogram', 'Time each shutter takes to reach its target.', [])
+        for i, histogram in moves:
+            lines.extend(histogram.render('paws_shutter_move_seconds', 'shutter="{0}"'.format(i)))
+        shutters = sorted(paws.shutters.items()) if paws.shutters is not None else []
+        metric('paws_shutter_state', 'gauge', 'State of each shutter, 1 for closed and 0 for open.', [('shutter="{0}"'.format(i), int(s.state)) for i, s in shutters])
+
+        # Boards
+        boards = getattr(paws.hardware, 'boards', [paws.hardware] if paws.hardware is not None else [])
+        calls = list()
+        for board in boards:
+            for call, count in sorted(board.calls.items()):
+                calls.append(('board="{0}",call="{1}"'.format(board.getSerialNum(), call), count))
+        metric('paws_usb_calls_total', 'counter', 'Calls to the boards, by method.', calls)
+
+        # Runs
+        progress = paws.get_progress()
+        shuttering = paws.shuttering
+        metric('paws_shuttering_loops', 'gauge', 'Alternations of the shuttering in progress.', [('', shuttering[1] if shuttering is not None else 0)])
+        metric('paws_shuttering_loops_done', 'gauge', 'Alternations of the shuttering in progress done.', [('', progress[0] if progress is not None else 0)])
+        metric('paws_queue_protocols', 'gauge', 'Protocols waiting in the queue.', [('', len(paws.protocols))])
+        runs = list(paws.runs)
+        metric('paws_run_overruns', 'gauge', 'Events later than the precision of the TimeKeeper, in the runs in progress or last done.', [('', sum([r.overruns for r in runs]))])
+        metric('paws_run_skipped', 'gauge', 'Late events skipped, in the runs in progress or last done.', [('', sum([r.skipped for r in runs]))])
+        return '\n'.join(lines) + '\n'
+
+    def stop(self):
+        """Stop serving and stop listening to PAWS."""
+        if self.scheduled in self.paws.todo.timings.observers:
+            self.paws.todo.timings.observers.remove(self.scheduled)
+        if self.transition in self.paws.motion.observers:
+            self.paws.motion.observers.remove(self.transition)
+        self.server.shutdown()
+        self.server.server_close()
@@ -3,68 +3,834 @@
 """
 Programmable Alternating/Waiting Shutter with graphical interface.
 
+Usage:
+    python paws.py [--settings paws.conf] [--headless] [--run protocol.json] [--late fire|skip|compress] [--listen /tmp/paws.sock] [--metrics 9062] [--log transitions.log] [--simulate] [--boards SERIAL ...] [--isolate]
+
+The graphical interface (see gui.py) and NumPy are only imported when they are used, so that PAWS starts fast and runs headless on machines without GTK nor a display.
+
 @author: Corentin Moevus cjm2206@columbia.edu
 """
 from __future__ import absolute_import, division, unicode_literals, print_function
 import time
 import os
+import logging
 import pickle
 import threading
-from Queue import PriorityQueue
-from math import ceil
-import numpy as np
-import Phidgets
-from Phidgets.Devices.Stepper import Stepper
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GLib
+import itertools
+import json
+import mmap
+import struct
+import socket
+import select
+import argparse
+from heapq import heappush, heappop, heapify
+from collections import deque
+from Queue import Empty
+from array import array
+
+try:
+    import Phidgets
+    from Phidgets.Devices.Stepper import Stepper
+except ImportError:
+    # Without the Phidgets library, only simulated hardware can be used.
+    Phidgets = None
+    Stepper = object
+
+logger = logging.getLogger('paws')
+
+
+def system_monotonic():
+    """Return a function returning the time (in seconds) of the monotonic clock of the system, read through ctypes, or None if it cannot be read."""
+    import sys
+    import ctypes
+    try:
+        if sys.platform.startswith('win'):
+            frequency, counter = ctypes.c_int64(), ctypes.c_int64()
+            kernel32 = ctypes.windll.kernel32
+            kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+
+            def now():
+                """Return the time of the performance counter."""
+                kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+                return counter.value / frequency.value
+            return now
+
+        if sys.platform == 'darwin':
+            class Timebase(ctypes.Structure):
+                _fields_ = [(str('numer'), ctypes.c_uint32), (str('denom'), ctypes.c_uint32)]
+            libc = ctypes.CDLL(str('/usr/lib/libc.dylib'))
+            libc.mach_absolute_time.restype = ctypes.c_uint64
+            timebase = Timebase()
+            libc.mach_timebase_info(ctypes.byref(timebase))
+            scale = timebase.numer / timebase.denom * 1e-9
+            return lambda: libc.mach_absolute_time() * scale
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [(str('tv_sec'), ctypes.c_long), (str('tv_nsec'), ctypes.c_long)]
+        # clock_gettime is in the C library since glibc 2.17, and in librt before.
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'clock_gettime'):
+            libc = ctypes.CDLL(str('librt.so.1'), use_errno=True)
+        CLOCK_MONOTONIC = 1
+        spec = Timespec()
+
+        def now():
+            """Return the time of CLOCK_MONOTONIC."""
+            if libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        now()
+        return now
+    except (OSError, AttributeError):
+        return None
+
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2: use the backport from PyPI if it is installed, or the clock of the system.
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = system_monotonic()
+        if monotonic is None:
+            logger.warning("No monotonic clock: the time of the computer is used instead, and changing it moves the planned events. Install the monotonic package.")
+            monotonic = time.time
+
+
+def socketpair():
+    """Return two connected sockets, as socket.socketpair, which Python 2 does not have on Windows."""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        b = listener.accept()[0]
+    finally:
+        listener.close()
+    return a, b
+
+
+class Wakeup(object):
+    """
+    Condition for one waiting thread, woken up through a pair of sockets.
+
+    The timed waits of threading.Condition poll under Python 2, sleeping up to 50 ms between two looks: a thread waiting with a timeout is woken up late when it is notified, and wakes up 20 times per second while it waits. Wakeup waits on select() instead, which returns as soon as it is notified, or at the end of the timeout, and measures the timeout on a monotonic clock. It can be used like a threading.Condition, but it is not reentrant, and notifications wake up the waiting thread without telling why: it must look at what it waits for again.
+    """
+
+    def __init__(self):
+        """Open the sockets."""
+        self.lock = threading.Lock()
+        self.reader, self.writer = socketpair()
+        self.reader.setblocking(False)
+
+        # Whether a notification is waiting in the sockets, so that there is never more than one.
+        self.notified = False
+
+    def acquire(self, blocking=True):
+        """Lock the condition."""
+        return self.lock.acquire(blocking)
+
+    def release(self):
+        """Unlock the condition."""
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        """Unlock the condition."""
+        self.lock.release()
+
+    def wait(self, timeout=None, woken=None):
+        """Unlock the condition, held by the caller, until it is notified or interrupted or for at most <timeout> seconds, and lock it again. <woken> is called once the thread is woken up, before it locks the condition again."""
+        self.lock.release()
+        try:
+            readable = select.select([self.reader], [], [], timeout)[0]
+            if woken is not None:
+                woken()
+        finally:
+            self.lock.acquire()
+        if len(readable) > 0 or self.notified is True:
+            # Read the notification, and the interruptions that came along.
+            try:
+                self.reader.recv(64)
+            except socket.error:
+                pass
+            self.notified = False
+
+    def notify(self):
+        """Wake up the waiting thread, if any. The caller must hold the condition."""
+        if self.notified is False:
+            self.notified = True
+            self.writer.send(b'.')
+
+    notify_all = notify
+
+    def interrupt(self):
+        """Wake up the waiting thread, if any, without holding the condition, such as from a thread holding another one. The thread may be woken up once more, later."""
+        self.writer.send(b'!')
+
+
+class Mailbox(object):
+    """Queue of messages for one reading thread, like Queue.Queue, whose timed gets wait on a Wakeup rather than polling."""
+
+    def __init__(self):
+        """Start with no messages."""
+        self.messages = deque()
+        self.condition = Wakeup()
+
+    def put(self, message):
+        """Add <message> at the end of the queue."""
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        """Return the first message, waiting for one for at most <timeout> seconds (forever if None) if <block> is True. Raise Queue.Empty if there is none."""
+        with self.condition:
+            if block is True and timeout is not None:
+                deadline = monotonic() + timeout
+            while len(self.messages) == 0:
+                if block is False:
+                    raise Empty
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.condition.wait(remaining)
+            return self.messages.popleft()
+
+
+class Clock(object):
+    """
+    Time of PAWS: the real time.
+
+    The objects of PAWS read the time and wait through a Clock, so that the real time can be replaced by a VirtualClock. The Clock counts the activities in progress, such as moves of the motors.
+    """
+
+    def __init__(self):
+        """Start the clock."""
+        self.activities = 0
+        self.condition = threading.Condition()
+
+    def now(self):
+        """Return the time (in seconds) on a monotonic clock, for scheduling and measuring durations."""
+        return monotonic()
+
+    def time(self):
+        """Return the time in seconds since the epoch, like time.time()."""
+        return time.time()
+
+    def sleep(self, seconds):
+        """Wait for <seconds>."""
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout=None):
+        """Wait until <condition> (a Wakeup), held by the caller, is notified, or for at most <timeout> seconds."""
+        condition.wait(timeout)
+
+    def leave(self):
+        """Tell that the calling thread, which waited on the clock, is done and will not wait on it again (see VirtualClock)."""
+        pass
+
+    def block(self):
+        """Keep the time from moving forward while the caller works, such as the MotionController handling a message (see VirtualClock). The real time goes on anyway."""
+        pass
+
+    def unblock(self):
+        """Let the time move forward again, once the work that blocked it is done."""
+        pass
+
+    def begin(self):
+        """Mark the start of an activity, such as a move of the motors."""
+        with self.condition:
+            self.activities += 1
+
+    def end(self):
+        """Mark the end of an activity."""
+        with self.condition:
+            self.activities -= 1
+            self.condition.notify_all()
+
+
+class VirtualClock(Clock):
+    """
+    Virtual time, that jumps forward instead of waiting, so that protocols run as fast as the CPU allows.
+
+    The threads waiting on the clock, such as the TimeKeeper and the simulated boards, tell it until when they wait. Once none of them is running, nor about to be woken up by a notification, the clock jumps to the earliest of their deadlines, if it is not past it yet, and wakes up the thread waiting until then. Hence, each thread sees the events of the others in the order they would be in real time, and events are done at their time even while motors move. Threads are woken up one at a time, the earliest deadline first, so that they do the same things in the same order in every run. Nobody moves it forward while it is blocked (see Clock.block), such as while the MotionController sends a burst of moves to the board, so that the moves take the same virtual time in every run.
+
+    Arguments:
+        start <float>: initial time of the clock (see Clock.now). Defaults to 0.
+    """
+
+    def __init__(self, start=0):
+        """Start the clock."""
+        Clock.__init__(self)
+        self.t = start
+        self.epoch = time.time() - start
+        self.blocked = 0
+
+        # Threads waiting on the clock, as {thread: (deadline, order of the wait, condition)}, the deadline being None for the ones waiting to be notified, and the threads that waited on the clock and are running.
+        self.waiting = dict()
+        self.running = set()
+        self.count = itertools.count()
+
+    def now(self):
+        """Return the virtual time."""
+        return self.t
+
+    def time(self):
+        """Return the virtual time since the epoch, starting from the real time at which the clock was made."""
+        return self.epoch + self.t
+
+    def sleep(self, seconds):
+        """Move the clock forward by <seconds>, once the threads waiting on the clock are not running, so that they only see it move while they wait."""
+        thread = threading.current_thread()
+        with self.condition:
+            while thread not in self.running and self.is_busy():
+                self.condition.wait()
+            self.t += seconds
+            self.advance()
+
+    def wait(self, condition, timeout=None):
+        """Wait until <condition> is notified, or until the clock reaches <timeout> seconds from now."""
+        thread = threading.current_thread()
+        with self.condition:
+            self.waiting[thread] = (None if timeout is None else self.t + timeout, next(self.count), condition)
+            self.running.discard(thread)
+            self.condition.notify_all()
+            self.advance()
+
+        def woken():
+            """Count the thread as running again."""
+            with self.condition:
+                self.waiting.pop(thread, None)
+                self.running.add(thread)
+        condition.wait(woken=woken)
+
+    def leave(self):
+        """Stop counting the calling thread as one that waits on the clock."""
+        thread = threading.current_thread()
+        with self.condition:
+            self.waiting.pop(thread, None)
+            self.running.discard(thread)
+            self.condition.notify_all()
+            self.advance()
+
+    def is_busy(self):
+        """Return whether a thread waiting on the clock is running, or notified and about to run. The caller must hold self.condition."""
+        return len(self.running) > 0 or any([c.notified for d, k, c in self.waiting.values()])
+
+    def advance(self):
+        """Wake up the waiting thread with the earliest deadline, moving the clock forward to it, if no thread is running nor notified, and the clock is not blocked. The caller must hold self.condition."""
+        if self.blocked > 0 or self.is_busy():
+            return
+        waiting = sorted([(d, k, thread) for thread, (d, k, c) in self.waiting.items() if d is not None])
+        if len(waiting) == 0:
+            return
+        deadline, k, thread = waiting[0]
+        self.t = max(self.t, deadline)
+        condition = self.waiting.pop(thread)[2]
+        self.running.add(thread)
+        condition.interrupt()
+
+    def block(self):
+        """Keep the clock from moving forward, until it is unblocked."""
+        with self.condition:
+            self.blocked += 1
+
+    def unblock(self):
+        """Let the clock move forward again."""
+        with self.condition:
+            self.blocked -= 1
+            self.advance()
+
+
+class Report(object):
+    """
+    Timeline of the transitions of shutters, and exposure of each channel, recorded during a run.
+
+    Record the transitions by adding Report.record to the observers of a MotionController. Transitions are kept in arrays, to fit long protocols in memory.
+
+    Arguments:
+        shutters <dict>: Shutter objects to record, by id, in their initial state
+        start <float>: time (see Clock.now) at which the run started
+        end <float>: time at which the run ends, if known. Defaults to None.
+    """
+
+    def __init__(self, shutters, start, end=None):
+        """Prepare the timeline."""
+        self.start, self.end = start, end
+        self.initial = dict([(i, s.state) for i, s in shutters.items()])
+        self.requested = array(b'd')
+        self.done = array(b'd')
+        self.shutter = array(b'i')
+        self.state = array(b'b')
+
+    def record(self, shutter, move):
+        """Record the transition of <shutter> done by <move>."""
+        self.requested.append(move.requested)
+        self.done.append(move.done[shutter.id])
+        self.shutter.append(shutter.id)
+        self.state.append(shutter.state)
+
+    def get_transitions(self):
+        """Return the transitions, as a list of (time requested, time done, shutter id, new state), relative to the start."""
+        return [(r - self.start, d - self.start, i, bool(s)) for r, d, i, s in zip(self.requested, self.done, self.shutter, self.state)]
+
+    def get_exposure(self, end=None):
+        """Return the time each shutter was open (False) from the start to <end> (see Clock.now; the end of the run, or the last transition, if None), as {shutter id: seconds}."""
+        if end is None:
+            end = self.end
+        if end is None:
+            end = self.done[-1] if len(self.done) > 0 else self.start
+        state = dict(self.initial)
+        since = dict([(i, self.start) for i in state.keys()])
+        exposure = dict([(i, 0) for i in state.keys()])
+        for t, i, s in zip(self.done, self.shutter, self.state):
+            if state[i] is False:
+                exposure[i] += t - since[i]
+            state[i], since[i] = bool(s), t
+        for i in state.keys():
+            if state[i] is False:
+                exposure[i] += end - since[i]
+        return exposure
+
+
+class TransitionLog(object):
+    """
+    Binary log of the transitions of the shutters, for matching them with the frames of a camera.
+
+    Record the transitions by adding TransitionLog.record to the observers of a MotionController. Each transition is a fixed-size record, appended to a memory-mapped file after a header holding the number of records. Writing a record takes a few microseconds, in the MotionController thread once the shutter is done, so it does not delay the moves. The file is extended by "grow" records in advance, from a thread of its own, when only half of that is left, and cut to its records when closed. Logs are read with TransitionLog.read.
+
+    Records are, in order (see TransitionLog.fields):
+        requested <float64>: time (see Clock.now) at which the move was requested
+        started <float64>: time at which the shutter was sent to its target
+        done <float64>: time at which the shutter reached its target
+        wall <float64>: time at which the shutter reached its target, in seconds since the epoch
+        loop <int64>: loop of the protocol the move belongs to, -1 if it is not part of one (see Move)
+        shutter <int32>: id of the shutter
+        state <uint8>: new state of the shutter, 1 for closed and 0 for open
+
+    Arguments:
+        f <str>: path of the log file. Records are appended to it if it exists.
+        clock <Clock>: time of the moves. Defaults to the real time.
+        grow <int>: number of records the file is extended by when it is full. Defaults to 65536 (3 MB).
+    """
+
+    magic = b'PAWSLOG1'
+    header = struct.Struct(b'<8sQ')
+    entry = struct.Struct(b'<ddddqiB3x')
+    fields = [('requested', '<f8'), ('started', '<f8'), ('done', '<f8'), ('wall', '<f8'), ('loop', '<i8'), ('shutter', '<i4'), ('state', 'u1'), ('padding', 'V3')]
+
+    def __init__(self, f, clock=None, grow=65536):
+        """Open the log and map it in memory."""
+        self.path, self.grow = f, grow
+        self.clock = Clock() if clock is None else clock
+        self.lock = threading.Lock()
+        self.grower = None
+
+        # Read the number of records of an existing log, or start a new one
+        self.file = open(f, 'r+b' if os.path.isfile(f) else 'w+b')
+        head = self.file.read(self.header.size)
+        if len(head) == self.header.size and head[:8] == self.magic:
+            self.count = self.header.unpack(head)[1]
+        else:
+            self.count = 0
+        self.map = None
+        self.resize(self.count + grow)
+
+    def resize(self, records):
+        """Make the file hold <records> records, and map it in memory again. The caller must hold self.lock."""
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.size = records
+        self.file.truncate(self.header.size + records * self.entry.size)
+        self.map = mmap.mmap(self.file.fileno(), self.header.size + records * self.entry.size)
+        self.header.pack_into(self.map, 0, self.magic, self.count)
+
+    def extend(self, records):
+        """Make the file hold <records> records, mapping it again without stopping the records for longer than it takes to swap the maps. Nothing is done if the file is already that large, or closed."""
+        with self.lock:
+            if self.map is None or records <= self.size:
+                return
+            self.file.truncate(self.header.size + records * self.entry.size)
+        try:
+            extended = mmap.mmap(self.file.fileno(), self.header.size + records * self.entry.size)
+        except (ValueError, EnvironmentError):
+            # The log was closed meanwhile.
+            return
+        with self.lock:
+            if self.map is None or records <= self.size:
+                extended.close()
+                return
+            old, self.map = self.map, extended
+            self.size = records
+            self.header.pack_into(self.map, 0, self.magic, self.count)
+        old.flush()
+        old.close()
+
+    def record(self, shutter, move):
+        """Record the transition of <shutter> done by <move>."""
+        i = shutter.id
+        done = move.done[i]
+        with self.lock:
+            if self.map is None:
+                return
+            if self.count == self.size:
+                # The log filled up before it could be extended in advance.
+                self.resize(self.size + self.grow)
+            self.entry.pack_into(self.map, self.header.size + self.count * self.entry.size, move.requested, move.started.get(i, done), done, self.clock.time() - self.clock.now() + done, move.get_loop(i), i, shutter.state)
+
+            # Count the record once it is written, so that readers only see whole records
+            self.count += 1
+            self.header.pack_into(self.map, 0, self.magic, self.count)
+
+            # Extend the file before it is full, outside of the records.
+            if self.size - self.count <= self.grow // 2 and (self.grower is None or not self.grower.is_alive()):
+                self.grower = threading.Thread(target=self.extend, args=(self.size + self.grow, ))
+                self.grower.daemon = True
+                self.grower.start()
+
+    def close(self):
+        """Write the log to the disk, and cut the file to its records."""
+        if self.grower is not None:
+            self.grower.join()
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.header.size + self.count * self.entry.size)
+            self.file.close()
+
+    @classmethod
+    def read(cls, f):
+        """Return the records of the log file <f> as a NumPy structured array (see TransitionLog.fields), mapped on the file without copying it. Logs being written can be read: only the records written so far are given."""
+        import numpy as np
+        with open(f, 'rb') as log:
+            magic, count = cls.header.unpack(log.read(cls.header.size))
+        if magic != cls.magic:
+            raise ValueError("{0} is not a PAWS transition log.".format(f))
+        dtype = np.dtype([(str(name), str(kind)) for name, kind in cls.fields])
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(f, dtype=dtype, mode='r', offset=cls.header.size, shape=(count, ))
+
+
+class Block(object):
+    """
+    Pattern of one shutter in a Sequence: steps keeping the shutter in a state for some time, done one after the other and repeated.
+
+    Blocks can be nested, to make bursts and loops within loops: Block([Block([(0.1, False), (0.1, True)], repeat=5), (10, True)], repeat=100) opens the shutter 5 times for 0.1s every 11s, 100 times.
+
+    Arguments:
+        steps <list>: (duration in seconds, state) tuples and Blocks. States are True for closed and False for open, like Shutter.state.
+        repeat <int>: number of times to do the steps. Defaults to 1.
+        offset <float>: time (in seconds) to wait before the first step, leaving the shutter as it is. Only used for the outermost Block of a shutter. Defaults to 0.
+    """
+
+    def __init__(self, steps, repeat=1, offset=0):
+        """Store the pattern."""
+        self.steps, self.repeat, self.offset = list(steps), repeat, offset
+
+    def flatten(self):
+        """Return the durations and states of the steps of one repetition, with the nested Blocks unrolled, as numpy arrays."""
+        import numpy as np
+        durations, states = [np.zeros(0)], [np.zeros(0, dtype=bool)]
+        for step in self.steps:
+            if isinstance(step, Block):
+                d, s = step.flatten()
+                durations.append(np.tile(d, step.repeat))
+                states.append(np.tile(s, step.repeat))
+            else:
+                durations.append(np.array([step[0]], dtype=float))
+                states.append(np.array([step[1]], dtype=bool))
+        return np.concatenate(durations), np.concatenate(states)
+
+    def get_duration(self):
+        """Return the time (in seconds) the pattern takes, offset included."""
+        return self.offset + self.repeat * self.flatten()[0].sum()
+
+    def get_last_state(self):
+        """Return the state the shutter is left in by the pattern, or None if it has no steps."""
+        if len(self.steps) == 0 or self.repeat == 0:
+            return None
+        last = self.steps[-1]
+        return last.get_last_state() if isinstance(last, Block) else last[1]
+
+    def to_dict(self):
+        """Return the pattern as a dict, as in the files of Sequence."""
+        steps = [s.to_dict() if isinstance(s, Block) else [s[0], s[1]] for s in self.steps]
+        return {'steps': steps, 'repeat': self.repeat, 'offset': self.offset}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Return the Block described by the dict <d> (see Block.to_dict)."""
+        steps = [cls.from_dict(s) if isinstance(s, dict) else (s[0], bool(s[1])) for s in d['steps']]
+        return cls(steps, d.get('repeat', 1), d.get('offset', 0))
+
+
+class Sequence(object):
+    """
+    Protocol giving each shutter its own pattern, compiled into a timeline of transitions.
+
+    Each shutter's pattern is a Block. Sequences are compiled into arrays of transitions, (time, shutter id, state) sorted by time, a chunk at a time, so that protocols with millions of transitions are run with a fixed amount of memory. Steps that do not change the state of the shutter are not transitions. Sequences are checked for transitions of a shutter that are closer than the time it takes to switch it before they are run.
+
+    Sequences are saved as JSON files: {"channels": {"<shutter id>": {"steps": [[duration, state], {nested block}, ...], "repeat": n, "offset": seconds}}}.
+
+    Arguments:
+        channels <dict>: Blocks to do, by shutter id
+        chunk <int>: approximate number of transitions compiled at once. Defaults to 10000.
+    """
+
+    def __init__(self, channels, chunk=10000):
+        """Store the protocol."""
+        self.channels, self.chunk = dict(channels), chunk
+
+    @classmethod
+    def load(cls, f):
+        """Return the Sequence saved in the file <f>."""
+        with open(f, 'r') as load:
+            d = json.load(load)
+        return cls(dict([(int(i), Block.from_dict(b)) for i, b in d['channels'].items()]))
+
+    def save(self, f):
+        """Save the Sequence in the file <f>."""
+        with open(f, 'w') as save:
+            json.dump({'channels': dict([(str(i), b.to_dict()) for i, b in self.channels.items()])}, save, indent=2)
+
+    def get_duration(self):
+        """Return the time (in seconds) the Sequence takes."""
+        return max([b.get_duration() for b in self.channels.values()] + [0])
+
+    def compile_channel(self, i):
+        """Return the transitions of one repetition of the pattern of shutter <i>, as (times from the start of the repetition, states, the period of the repetitions)."""
+        import numpy as np
+        durations, states = self.channels[i].flatten()
+        if len(durations) == 0 or np.any(durations <= 0):
+            raise ValueError("The steps of shutter {0} must last more than 0s.".format(i))
+        starts = np.concatenate(([0], np.cumsum(durations)[:-1]))
+        changes = states != np.roll(states, 1)
+        return starts[changes], states[changes], durations.sum()
+
+    def check(self, delays=None):
+        """
+        Check that no shutter is asked to switch while it is still switching.
+
+        Arguments:
+            delays <dict>: time (in seconds) each shutter takes to switch (see Shutter.delay), by shutter id. Transitions of a shutter closer than that are conflicts. If None, only transitions at the same time are.
+
+        Raise a ValueError describing the first conflict of each shutter, if any.
+        """
+        import numpy as np
+        delays = dict() if delays is None else delays
+        conflicts = list()
+        for i, block in self.channels.items():
+            times, states, period = self.compile_channel(i)
+
+            # Time between consecutive transitions, from the last one of a repetition to the first of the next one included
+            gaps = np.diff(times)
+            if block.repeat > 1 and len(times) > 0:
+                gaps = np.append(gaps, period - times[-1] + times[0])
+            late = np.flatnonzero(gaps < max(delays.get(i, 0), 1e-6))
+            if len(late) > 0:
+                conflicts.append("shutter {0} switches {1:.3f}s after {2:.3f}s, while it takes {3:.3f}s to switch".format(i, gaps[late[0]], block.offset + times[late[0] % len(times)], delays.get(i, 0)))
+        if len(conflicts) > 0:
+            raise ValueError("Conflicting moves: " + "; ".join(conflicts) + ".")
+
+    def compile(self, delays=None):
+        """
+        Yield the transitions of the Sequence, as chunks of (times, shutter ids, states, loops) numpy arrays sorted by time. Times are in seconds from the start of the Sequence, and loops are the repetitions of the shutters' Blocks the transitions belong to, from 0.
+
+        The first state of each shutter is always given, at its offset, whether it changes the state of the shutter or not.
+
+        Arguments:
+            delays <dict>: time (in seconds) each shutter takes to switch, by shutter id. Its transitions are started that much earlier. Defaults to None, for no compensation.
+        """
+        import numpy as np
+        delays = dict() if delays is None else delays
+        channels = list()
+        for i, block in self.channels.items():
+            times, states, period = self.compile_channel(i)
+            if len(times) == 0 or times[0] > 0:
+                # The first step does not change the state: add its state at the start of the first repetition.
+                initial = block.flatten()[1][:1]
+                channels.append((i, np.zeros(1), initial, 1, 1, block.offset - delays.get(i, 0)))
+            channels.append((i, times, states, period, block.repeat, block.offset - delays.get(i, 0)))
+        channels = [c for c in channels if len(c[1]) > 0 and c[4] > 0]
+        if len(channels) == 0:
+            return
+
+        # Compile windows of time expected to hold a chunk of transitions each.
+        rate = sum([len(c[1]) / c[3] for c in channels])
+        window = self.chunk / rate
+        t = min([c[5] + c[1][0] for c in channels])
+        end = max([c[5] + (c[4] - 1) * c[3] + c[1][-1] for c in channels])
+        while t <= end:
+            chunk = list()
+            for i, times, states, period, repeat, offset in channels:
+                # Repetitions with transitions in [t, t + window)
+                first = max(0, int(np.floor((t - offset - times[-1]) / period)))
+                last = min(repeat - 1, int(np.floor((t + window - offset - times[0]) / period)))
+                if last < first:
+                    continue
+                loops = np.arange(first, last + 1)[:, np.newaxis]
+                grid = offset + period * loops + times[np.newaxis, :]
+                inside = (grid >= t) & (grid < t + window)
+                chunk.append((grid[inside], np.full(inside.sum(), i, dtype=int), np.tile(states, (last - first + 1, 1))[inside], np.broadcast_to(loops, grid.shape)[inside]))
+            t += window
+            if len(chunk) == 0:
+                continue
+            times, ids, states, loops = [np.concatenate(c) for c in zip(*chunk)]
+            if len(times) == 0:
+                continue
+            order = np.lexsort((ids, times))
+            yield times[order], ids[order], states[order], loops[order]
+
+
+class Timings(object):
+    """
+    Keep the last timings of a repeated action, in a ring buffer, and summarize them.
+
+    The observers are called with the values each time they are recorded, from the thread recording them, so they must not block.
+
+    Arguments:
+        fields <list>: names of the values recorded each time
+        size <int>: number of records to keep. Defaults to 10000.
+    """
+
+    def __init__(self, fields, size=10000):
+        """Prepare the buffer."""
+        self.fields = list(fields)
+        self.records = deque(maxlen=size)
+        self.observers = list()
+
+    def add(self, *values):
+        """Record one value for each field, in the order of self.fields."""
+        self.records.append(values)
+        for observer in self.observers:
+            observer(*values)
+
+    def get(self, field):
+        """Return the recorded values of <field>, from the oldest to the newest."""
+        i = self.fields.index(field)
+        return [r[i] for r in list(self.records)]
+
+    def summary(self, field):
+        """Return the number, median, 99th percentile and maximum of the recorded values of <field>, as a dict. Values are None if nothing was recorded."""
+        values = sorted(self.get(field))
+        if len(values) == 0:
+            return {'count': 0, 'p50': None, 'p99': None, 'max': None}
+        return {'count': len(values),
+                'p50': values[int(0.5 * (len(values) - 1))],
+                'p99': values[int(0.99 * (len(values) - 1))],
+                'max': values[-1]}
+
+    def summaries(self):
+        """Return the summary of each field, as {field: summary}."""
+        return dict([(field, self.summary(field)) for field in self.fields])
 
 
 class TimeKeeper(threading.Thread):
     """
-    Do tasks at given time, with a time precision given by "precision".
+    Do tasks at given time.
 
-    The precision is actually the time the loop will wait before looking again into its task list to see if it is time for the next event. Hence, the lower the precision, the lower the resource consumption, and vice versa.
+    The TimeKeeper sleeps until the next event is due, and is woken up as soon as an earlier event is added. Hence, events are done on time without the TimeKeeper having to look into its task list periodically, and an idle TimeKeeper does not use any resource. Times are kept on a monotonic clock, so that changing the time of the computer does not affect the events already planned.
 
-    Running slow functions in TimeKeeper loop can cause delays in the precise execution of the following events, as the TimeKeeper will wait until the function is done before looking for things to do. Consider threading or multiprocessing heavy functions.
+    Long series of events can be given as timelines: iterables that yield the events in chronological order. Only the next event of each timeline is kept in the task list, so that the memory used does not depend on the length of the timeline. Each timeline, or single event, is a Run, which can be cancelled, paused and resumed while the other runs go on.
+
+    Events are given as times since the epoch, but kept on a monotonic clock: the times of a run are converted once, when it is added, so that changing the time of the computer, or NTP adjusting it, does not move the events already planned. An event later than "precision" is an overrun, which is counted (see Run.report) and handled according to the late policy of its run:
+        fire: do it as soon as possible, like the events on time. After a stall, all the overdue events are done in a burst.
+        skip: drop it, and go on with the next event of the run. The last event of a run is always done.
+        compress: do it, and delay the rest of the run by its lateness, as if the run had been paused during the stall. No events are dropped nor bunched up, and the run ends later.
+
+    Running slow functions in TimeKeeper loop can cause delays in the precise execution of the following events, as the TimeKeeper will wait until the function is done before looking for things to do. Consider threading or multiprocessing heavy functions. A warning is logged when a function takes longer than "precision". An event, or timeline, that raises an exception is logged and cancels the rest of its run only.
+
+    The scheduled time, the time at which it was actually done, its lateness and the duration of the function are recorded for each event in self.timings (see Timings).
 
     Arguments:
-        max_precision <float>: time (in seconds) to wait before checking for actions to do. Defaults to 0.5s.
+        precision <float>: time (in seconds) an event is allowed to be late, before it is an overrun. It does not change how often the TimeKeeper wakes up. Defaults to 0.5s.
+        clock <Clock>: time of the TimeKeeper. Defaults to the real time.
     """
 
-    def __init__(self, precision=0.5):
+    def __init__(self, precision=0.5, clock=None):
         """Start the object and the thread."""
         threading.Thread.__init__(self)
         self.precision = precision
-        self.queue = PriorityQueue()
+        self.clock = Clock() if clock is None else clock
+        self.queue = list()
+        self.stale = 0
+        self.count = itertools.count()
+        self.condition = Wakeup()
         self.daemon = True
         self.kill = threading.Event()
+        self.timings = Timings(['scheduled', 'dispatched', 'lateness', 'duration'])
         self.start()
 
     def run(self):
-        """Check for things to do."""
-        while self.kill.wait(self.precision) != True:
-            # Is there something to do?
-            if self.queue.empty() != True:
-                # Is that thing to be done now?
-                get = True
-                while get == True:
-                    action = self.queue.get()
-                    # Yes, do it.
-                    if action[0] <= time.time():
-                        if action[2] is None:
-                            action[1]()
-                        elif type(action[2]) == dict:
-                            action[1](**action[2])
-                        else:
-                            action[1](*action[2])
-
-                    # No, put it back in the list and wait for next round
+        """Wait for the next thing to do, and do it."""
+        with self.condition:
+            while self.kill.is_set() != True:
+                # Forget the next events of cancelled and paused runs.
+                while len(self.queue) > 0 and self.queue[0][4].entry is not self.queue[0]:
+                    heappop(self.queue)
+                    self.stale -= 1
+
+                # Is there something to do? No, sleep until something is added.
+                if len(self.queue) == 0:
+                    self.clock.wait(self.condition)
+                    continue
+
+                # Is that thing to be done now? No, sleep until it is, or until something earlier is added.
+                delay = self.queue[0][0] - self.clock.now()
+                if delay > 0:
+                    self.clock.wait(self.condition, delay)
+                    continue
+
+                # Yes, get the next one from its run, and handle it according to the late policy of the run if it is overdue.
+                t, i, func, args, run = heappop(self.queue)
+                run.entry = None
+                late = -delay > self.precision
+                if late is True:
+                    run.overruns += 1
+                    if run.late == 'compress':
+                        run.shift -= delay
+                self.push_next(run)
+                if late is True and run.late == 'skip' and run.entry is not None:
+                    run.skipped += 1
+                    continue
+
+                # Do it, without locking the task list.
+                run.done += 1
+                self.condition.release()
+                dispatched = self.clock.now()
+                try:
+                    if args is None:
+                        func()
+                    elif type(args) == dict:
+                        func(**args)
                     else:
-                        self.queue.put(action)
-                        get = False
-
-    def add(self, t, func, args=None):
+                        func(*args)
+                except Exception:
+                    # Only the run of the failing event is stopped, so that the TimeKeeper goes on with the other ones.
+                    logger.exception('%s failed: the rest of its run is cancelled.', getattr(func, '__name__', func))
+                    run.cancel()
+                finally:
+                    duration = self.clock.now() - dispatched
+                    self.timings.add(t, dispatched, dispatched - t, duration)
+                    if duration > self.precision:
+                        logger.warning('%s took %.3fs, more than the TimeKeeper precision (%.3fs): the following events are late.', getattr(func, '__name__', func), duration, self.precision)
+                    self.condition.acquire()
+        self.clock.leave()
+
+    def add(self, t, func, args=None, late='fire'):
         """
         Add a thing to do.
 
@@ -72,79 +838,729 @@ class TimeKeeper(threading.Thread):
             t <float>: time in seconds since the epoch (like the output of time.time()) at which to do the action. If time is lesser than time.time() - 10, it will be added to current time.time(), so that if you want something to be done in 10seconds, you can simply enter time=10.
             func <callable>: function to call when time.time() == time
             args <list, tuple, dict>: arguments to pass to the function when executing it.
+            late <str>: what to do if it is late: 'fire', 'skip' or 'compress' (see TimeKeeper). Defaults to 'fire'.
+
+        Return the Run of the thing to do.
         """
-        if t < time.time() - 10:
-            t += time.time()
-        self.queue.put([t, func, args])
+        return self.add_timeline([(t, func, args)], late)
+
+    def add_timeline(self, timeline, late='fire'):
+        """
+        Add a series of things to do.
+
+        Arguments:
+            timeline <iterable>: yields (t, func, args) tuples, as the arguments of TimeKeeper.add, in chronological order. It is only iterated upon when the previous thing to do is done.
+            late <str>: what to do with the things to do that are late: 'fire', 'skip' or 'compress' (see TimeKeeper). Defaults to 'fire'.
+
+        Return the Run of the timeline.
+        """
+        run = Run(self, iter(timeline), late)
+        with self.condition:
+            self.push_next(run)
+        return run
+
+    def push(self, t, func, args, run):
+        """Put a thing to do of <run> in the task list. The caller must hold self.condition."""
+        if t < run.start - 10:
+            t += run.start
+        self.insert((t + run.offset + run.shift, next(self.count), func, args, run))
+
+    def insert(self, event):
+        """Put <event> in the task list, as the next event of its run. The caller must hold self.condition."""
+        event[4].entry = event
+        heappush(self.queue, event)
+
+        # Wake the loop up if this is the new next thing to do.
+        if self.queue[0] is event:
+            self.condition.notify()
+
+    def push_next(self, run):
+        """Put the next thing to do of <run>, if any, in the task list. The caller must hold self.condition."""
+        try:
+            t, func, args = next(run.timeline)
+        except StopIteration:
+            return
+        except Exception:
+            logger.exception('The timeline of a run failed: the rest of the run is cancelled.')
+            run.cancelled = True
+            run.timeline = iter(())
+            return
+        self.push(t, func, args, run)
+
+    def discard(self, run):
+        """
+        Take the next event of <run> out of the task list. The caller must hold self.condition.
+
+        The event is only marked as stale, and dropped once it is the next one, so that it takes the same time whatever the size of the task list. The list is rebuilt without the stale events when they are more than half of it, so that the memory they use stays bounded.
+        """
+        if run.entry is None:
+            return
+        run.entry = None
+        self.stale += 1
+        if self.stale > len(self.queue) // 2:
+            self.queue = [e for e in self.queue if e[4].entry is e]
+            heapify(self.queue)
+            self.stale = 0
+
+    def pending(self):
+        """Return the number of things to do in the task list, not counting the ones of cancelled and paused runs. The caller must hold self.condition."""
+        return len(self.queue) - self.stale
 
     def stop(self):
         """Kill the TimeKeeper."""
         self.kill.set()
+        with self.condition:
+            self.condition.notify()
 
     __del__ = stop
 
 
-class Shutter(threading.Thread):
+class Run(object):
     """
-    Control one physical motor as a shutter.
+    Timeline, or single event, scheduled on a TimeKeeper (see TimeKeeper.add_timeline).
+
+    Cancelling or pausing a run only takes its next event out of the task list (see TimeKeeper.discard), so that the other runs go on, on the same TimeKeeper. An event already being done is not interrupted. Resuming a run shifts the rest of its timeline by the time it was paused for.
+
+    Arguments:
+        keeper <TimeKeeper>: TimeKeeper the run is scheduled on
+        timeline <iterator>: events of the run (see TimeKeeper.add_timeline)
+        late <str>: what to do with the events that are late: 'fire', 'skip' or 'compress' (see TimeKeeper). Defaults to 'fire'.
+    """
+
+    policies = ('fire', 'skip', 'compress')
+
+    def __init__(self, keeper, timeline, late='fire'):
+        """Prepare the run."""
+        if late not in self.policies:
+            raise ValueError("Unknown late policy: {0}.".format(late))
+        self.keeper, self.timeline, self.late = keeper, timeline, late
+        self.cancelled = False
+
+        # Time since the epoch at which the run was added, and difference between the monotonic clock and that time, for converting the times of its events once and for all.
+        self.start = keeper.clock.time()
+        self.offset = keeper.clock.now() - self.start
+
+        # Number of events done, late by more than the precision of the TimeKeeper, and dropped for being late.
+        self.done = 0
+        self.overruns = 0
+        self.skipped = 0
+
+        # Next event of the run in the task list, or put aside while the run is paused, with the time it was paused at.
+        self.entry = None
+        self.paused = None
+
+        # Time (in seconds) the events of the run are delayed by, as the total time it was paused for.
+        self.shift = 0
+
+    @property
+    def finished(self):
+        """Whether the run has nothing left to do, having been cancelled or done all its events."""
+        return self.entry is None and self.paused is None
+
+    def report(self):
+        """
+        Return the state of the run, as a dict:
+            late: late policy of the run
+            done: number of events done
+            overruns: number of events later than the precision of the TimeKeeper
+            skipped: number of events dropped for being late
+            delay: time (in seconds) the rest of the run is delayed by, by pauses and compressed overruns
+            finished: whether the run has nothing left to do
+            cancelled: whether the run was cancelled
+        """
+        with self.keeper.condition:
+            return {'late': self.late, 'done': self.done, 'overruns': self.overruns, 'skipped': self.skipped,
+                    'delay': self.shift, 'finished': self.finished, 'cancelled': self.cancelled}
+
+    def cancel(self):
+        """Drop the events of the run that were not done yet."""
+        with self.keeper.condition:
+            self.cancelled = True
+            self.paused = None
+            self.keeper.discard(self)
+            self.timeline = iter(())
+
+    def pause(self):
+        """Stop doing the events of the run, until it is resumed."""
+        with self.keeper.condition:
+            if self.entry is not None:
+                self.paused = (self.entry, self.keeper.clock.now())
+                self.keeper.discard(self)
+
+    def resume(self):
+        """Go on doing the events of a paused run, later by the time it was paused for."""
+        with self.keeper.condition:
+            if self.paused is not None:
+                entry, t = self.paused
+                self.paused = None
+                shift = self.keeper.clock.now() - t
+                self.shift += shift
+                self.keeper.insert((entry[0] + shift, next(self.keeper.count), entry[2], entry[3], self))
+
+
+class Move(object):
+    """
+    Switch of one or several shutters at once, as done by a MotionController.
+
+    Arguments:
+        shutters <list>: Shutter objects to switch
+        clock <Clock>: time of the move. Defaults to the real time.
+        loop <int, dict>: loop of the protocol the move belongs to, from 0, or loops by shutter id. None if it is not part of a protocol. Defaults to None.
+
+    Attributes:
+        requested <float>: time (see Clock.now) at which the move was requested
+        started <dict>: time at which each shutter was sent to its target, by shutter id
+        done <dict>: time at which each shutter reached its target, by shutter id
+        stalled <dict>: number of positions each shutter stopped short of its target, by shutter id, for the shutters that skipped steps
+        error <Exception>: error that stopped the move, None if there was none
+        finished <threading.Event>: set once all the shutters reached their target, or once the move failed
+
+    A Move can span several boards, each of its shutters being moved by the MotionController of its board (see MotionPool).
+    """
+
+    def __init__(self, shutters, clock=None, loop=None):
+        """Prepare the move."""
+        self.shutters = list(shutters)
+        self.clock = Clock() if clock is None else clock
+        self.loop = loop
+        self.requested = self.clock.now()
+        self.started = dict()
+        self.done = dict()
+        self.stalled = dict()
+        self.error = None
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+        # Whether the move is over, done or failed, so that it is only ended once.
+        self.over = False
+        if len(self.shutters) == 0:
+            self.over = True
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        """Wait for all the shutters to reach their target. Return False if it timed out."""
+        return self.finished.wait(timeout)
+
+    def finish(self, shutter, t):
+        """Record that <shutter> reached its target at time <t>. Return True if it is the last shutter of the move to do so, and the move did not fail."""
+        with self.lock:
+            self.done[shutter.id] = t
+            if self.over is False and len(self.done) == len(self.shutters):
+                self.over = True
+                return True
+            return False
+
+    def fail(self, error):
+        """Record that the move was stopped by <error>. Return True if the move was not over yet, for the caller to end it."""
+        with self.lock:
+            if self.error is None:
+                self.error = error
+            if self.over is True:
+                return False
+            self.over = True
+            return True
+
+    def get_loop(self, i):
+        """Return the loop of the protocol the move of shutter <i> belongs to, or -1 if it is not part of a protocol."""
+        loop = self.loop.get(i) if type(self.loop) == dict else self.loop
+        return -1 if loop is None else loop
+
+    def report(self):
+        """
+        Return the timing of the move, in seconds, as a dict:
+            latency: time between the request and the first shutter being sent to its target
+            skew: time between the first and last shutters being sent to their target
+            done_skew: time between the first and last shutters reaching their target
+            duration: time between the request and the last shutter reaching its target
+        """
+        if len(self.done) == 0:
+            return {'latency': None, 'skew': 0, 'done_skew': 0, 'duration': None}
+        started, done = self.started.values(), self.done.values()
+        return {'latency': min(started) - self.requested,
+                'skew': max(started) - min(started),
+                'done_skew': max(done) - min(done),
+                'duration': max(done) - self.requested}
+
+
+class MotionController(threading.Thread):
+    """
+    Move all the motors of one Phidgets board.
+
+    Shutters send their switching requests to the MotionController, which starts the move as soon as a request arrives. Shutters switched together are all engaged, then all sent to their target, in one burst. Moves are finished as soon as the board reports that the motor reached its target or stopped. If the board does not report it within "timeout" seconds, the motor's position is polled every "moving_wait" seconds instead. A motor found stopped short of its target skipped steps: its move is finished anyway, and the stall is logged and recorded in Move.stalled. Only boards with position feedback can tell (not the 1062, which has no encoder).
+
+    A call to the board that fails stops the move it was done for: the error is logged and kept in Move.error, the move is finished without its shutters changing state, and the MotionController goes on with the other moves.
+
+    The observers are called with (shutter, move) each time a shutter reaches its target. They are called after the move is set as finished and the moves waiting for the motor are started, so that they do not delay the shutters.
 
     Arguments:
         hardware: Opened and attached Stepper() object (for concision, a Hardware instance)
-        id: ID of the motor as indicated on the Phidgets board (0 to 3)
+        clock <Clock>: time of the moves. Defaults to the real time.
+    """
+
+    def __init__(self, hardware, clock=None):
+        """Start the object and the thread."""
+        threading.Thread.__init__(self)
+        self.hardware = hardware
+        self.clock = Clock() if clock is None else clock
+        self.observers = list()
+        self.messages = Mailbox()
+        self.daemon = True
+
+        # Moving motors, as {motor id: (move, shutter, target position, time of next check)}, messages waiting for their motors to stop, and shutters that reached their target, with their move and whether it was the last of the move, for the observers.
+        self.moving = dict()
+        self.deferred = list()
+        self.reached = list()
+
+        # Time to wait for the board to report the end of a move, then between two checks on the motor.
+        self.timeout = 2
+        self.moving_wait = 0.1
+
+        # Timings of the last moves (see Move.report)
+        self.timings = Timings(['latency', 'skew', 'done_skew', 'duration'])
+
+        # Time between two checks of the position model against the board, done when no motor is moving.
+        self.check_interval = 60
+        self.last_check = self.clock.now()
+
+        # Listen to the motors
+        if self.hardware is not None:
+            self.hardware.listeners.append(self)
+
+        self.start()
+
+    def run(self):
+        """Start moves when requested and finish them when the motors stop."""
+        while True:
+            # Wait for a message, or for the next check on a moving motor.
+            timeout = None
+            if len(self.moving) > 0:
+                timeout = max(0, min([m[3] for m in self.moving.values()]) - self.clock.now())
+            try:
+                message = self.messages.get(True, timeout)
+                posted = True
+            except Empty:
+                message = ('check', )
+                posted = False
+
+            # Act on it.
+            if message[0] == 'stop':
+                self.clock.unblock()
+                break
+            elif message[0] in ('switch', 'hold'):
+                self.deferred.append(message)
+            elif message[0] == 'stopped':
+                self.check(message[1], message[2], message[3], True, message[4])
+            elif message[0] == 'check':
+                for i, (move, shutter, target, t) in list(self.moving.items()):
+                    if t <= self.clock.now():
+                        self.check(i)
+
+            # Start the moves, and hold or release the motors, that are not moving.
+            deferred, self.deferred = self.deferred, list()
+            for message in deferred:
+                shutters = message[1].shutters if message[0] == 'switch' else message[1]
+                if any([s.motor in self.moving for s in shutters if s.controller is self]):
+                    self.deferred.append(message)
+                elif message[0] == 'switch':
+                    try:
+                        self.begin(message[1])
+                    except Exception as e:
+                        logger.exception('Shutters %s could not be switched.', [s.id for s in message[1].shutters if s.controller is self])
+                        self.abort(message[1], e)
+                else:
+                    for shutter in shutters:
+                        try:
+                            shutter.set_held(message[2])
+                        except Exception:
+                            logger.exception('Shutter %s could not be held or released.', shutter.id)
+
+            # Tell the observers about the shutters done, now that the next moves are started.
+            self.tell_observers()
+
+            # Check the position model against the board, while nothing is moving.
+            if len(self.moving) == 0 and self.clock.now() - self.last_check > self.check_interval:
+                self.last_check = self.clock.now()
+                try:
+                    self.hardware.check_positions()
+                except Exception:
+                    logger.exception('The motor positions could not be checked.')
+
+            # The message is handled: the time can move forward (see Clock.block).
+            if posted is True:
+                self.clock.unblock()
+
+    def begin(self, move):
+        """Engage all the motors of <move> on this board, then send them all to their target."""
+        targets = [(s, s.get_target()) for s in move.shutters if s.controller is self]
+        t = self.clock.now() + self.timeout
+        for shutter, target in targets:
+            self.moving[shutter.motor] = (move, shutter, target, t)
+            shutter.engage()
+        for shutter, target in targets:
+            shutter.start_move(target)
+            move.started[shutter.id] = self.clock.now()
+
+    def abort(self, move, error):
+        """Stop <move> after <error>: forget its motors on this board, leave its shutters that are not done in their state, and finish it if it was not over."""
+        for i, entry in list(self.moving.items()):
+            if entry[0] is move:
+                del self.moving[i]
+        for shutter in move.shutters:
+            if shutter.controller is self and shutter.id not in move.done:
+                shutter.next_state = not shutter.next_state
+        if move.fail(error) is True:
+            move.finished.set()
+            self.clock.end()
+
+    def check(self, i, position=None, t_done=None, stopped=False, move=None):
+        """Finish the move of motor <i> if it is at its target <position> (read from the board if None), reached at <t_done> (now if None), or if it <stopped> short of its target, or check again later. Stop the move if the board fails. Events of the board about another <move> than the current one of the motor are stale, and ignored."""
+        if i not in self.moving or (move is not None and self.moving[i][0] is not move):
+            return
+        move = self.moving[i][0]
+        try:
+            self.check_motor(i, position, t_done, stopped)
+        except Exception as e:
+            logger.exception('Shutter %s could not be checked.', self.moving[i][1].id if i in self.moving else i)
+            self.abort(move, e)
+
+    def check_motor(self, i, position, t_done, stopped):
+        """Check motor <i> (see MotionController.check)."""
+        move, shutter, target, t = self.moving[i]
+        if position is None or (stopped is True and position != target):
+            position = self.hardware.getCurrentPosition(i)
+        if position != target and (stopped is True or t <= self.clock.now()) and self.hardware.getStopped(i):
+            logger.warning('Shutter %s stopped %d positions short of its target: its motor skipped steps.', shutter.id, abs(target - position))
+            move.stalled[shutter.id] = abs(target - position)
+            self.hardware.positions[i] = position
+        elif position != target:
+            if t <= self.clock.now():
+                self.moving[i] = (move, shutter, target, self.clock.now() + self.moving_wait)
+            return
+
+        # Done: tell the observers once the moves waiting for the motor are started (see MotionController.tell_observers).
+        del self.moving[i]
+        last = move.finish(shutter, self.clock.now() if t_done is None else t_done)
+        try:
+            shutter.end_move()
+        except Exception:
+            logger.exception('Shutter %s could not be released.', shutter.id)
+        if last is True:
+            move.finished.set()
+        self.reached.append((shutter, move, last))
+
+    def tell_observers(self):
+        """Call the observers for the shutters that reached their target, and end their moves once all their shutters did, after the moves on the critical path are done."""
+        reached, self.reached = self.reached, list()
+        for shutter, move, last in reached:
+            for observer in self.observers:
+                try:
+                    observer(shutter, move)
+                except Exception:
+                    logger.exception('An observer of the moves failed.')
+            if last is True:
+                report = move.report()
+                self.timings.add(*[report[field] for field in self.timings.fields])
+                self.clock.end()
+
+    def switch(self, shutters, loop=None):
+        """Ask for all <shutters> to be switched at once, as part of the <loop> of a protocol (see Move). Return the Move, without waiting for it to be done."""
+        move = Move(shutters, self.clock, loop)
+        for shutter in move.shutters:
+            shutter.next_state = not shutter.next_state
+        if len(move.shutters) > 0:
+            self.clock.begin()
+            self.post(('switch', move))
+        return move
+
+    def hold(self, shutters, held=True):
+        """Keep the motors of <shutters> engaged between moves, or release them if <held> is False, once they are not moving."""
+        self.post(('hold', list(shutters), held))
+
+    def locate(self, i):
+        """Return the MotionController and the motor of shutter <i>: this one and motor <i>, on a single board. Raise a ValueError if there is no such motor."""
+        if self.hardware is not None and not 0 <= i < self.hardware.getMotorCount():
+            raise ValueError("There is no motor {0} on the board.".format(i))
+        return self, i
+
+    def post(self, message):
+        """Send <message> to the thread, keeping the clock from moving forward until it is handled (see Clock.block)."""
+        self.clock.block()
+        self.messages.put(message)
+
+    def get_started(self, i):
+        """Return the move motor <i> was sent to the target of, or None if it is not moving."""
+        entry = self.moving.get(i)
+        if entry is None or entry[1].id not in entry[0].started:
+            return None
+        return entry[0]
+
+    def motor_moved(self, i, position):
+        """Handle a position change of motor <i> (called from the Phidgets thread)."""
+        move = self.get_started(i)
+        if move is not None and self.moving[i][2] == position:
+            self.post(('stopped', i, position, self.clock.now(), move))
+
+    def motor_stopped(self, i):
+        """Handle the stop of motor <i> (called from the Phidgets thread)."""
+        move = self.get_started(i)
+        if move is not None:
+            self.post(('stopped', i, self.hardware.get_position(i), self.clock.now(), move))
+
+    def stop(self):
+        """Stop the thread."""
+        self.post(('stop', ))
+
+
+class MotionPool(object):
+    """
+    Move the motors of the boards of a Pool, with one MotionController per board, so that the calls to one board never wait for the calls to another one.
+
+    Shutters switched together on several boards share one Move: each MotionController moves the shutters of its board, and the last one to be done finishes the Move. The skew of a Move (see Move.report) is then the skew across the boards. The observers and timings are shared by all the MotionControllers, and have the same meaning as for one MotionController.
+
+    Arguments:
+        hardware <Pool>: opened boards
+        clock <Clock>: time of the moves. Defaults to the real time.
+    """
+
+    def __init__(self, hardware, clock=None):
+        """Start a MotionController for each board."""
+        self.hardware = hardware
+        self.clock = Clock() if clock is None else clock
+        self.observers = list()
+        self.timings = Timings(['latency', 'skew', 'done_skew', 'duration'])
+        self.controllers = list()
+        for board in self.hardware.boards:
+            controller = MotionController(board, self.clock)
+            controller.observers = self.observers
+            controller.timings = self.timings
+            self.controllers.append(controller)
+
+    def locate(self, i):
+        """Return the MotionController and the motor of shutter <i> (see Pool.locate)."""
+        board, motor = self.hardware.locate(i)
+        return self.controllers[board], motor
+
+    def switch(self, shutters, loop=None):
+        """Ask for all <shutters> to be switched at once, by the MotionControllers of their boards (see MotionController.switch). Return the Move."""
+        move = Move(shutters, self.clock, loop)
+        for shutter in move.shutters:
+            shutter.next_state = not shutter.next_state
+        if len(move.shutters) > 0:
+            self.clock.begin()
+            for controller in self.controllers:
+                if any([s.controller is controller for s in move.shutters]):
+                    controller.post(('switch', move))
+        return move
+
+    def hold(self, shutters, held=True):
+        """Keep the motors of <shutters> engaged between moves, or release them (see MotionController.hold)."""
+        shutters = list(shutters)
+        for controller in self.controllers:
+            mine = [s for s in shutters if s.controller is controller]
+            if len(mine) > 0:
+                controller.hold(mine, held)
+
+    def stop(self):
+        """Stop the threads."""
+        for controller in self.controllers:
+            controller.stop()
+
+    def join(self, timeout=None):
+        """Wait for the threads to be stopped, for at most <timeout> seconds each."""
+        for controller in self.controllers:
+            controller.join(timeout)
+
+
+class Shutter(object):
+    """
+    Control one physical motor as a shutter.
+
+    Arguments:
+        controller: MotionController of the board the motor is plugged in
+        id: ID of the shutter, which is also the motor as indicated on the Phidgets board (0 to 3) unless <motor> is given
         step <float>: angle, in degrees, of one of the motor step (given by motor manufacturer)
         angle <float>: the number of degrees to move when switching the motor's position
         direction <bool>: direction of the movement. True or False may mean up or down, depending on the motor's wiring and orientation. You need to test it to know it.
         state <bool>: Current state of the motor. True if it is closed (blocks the beam) and False if it is open (let the beam through). Defaults to True.
-        gui <Gtk.Switch>: Associated GUI object to record state changes
+        delay <float>: time (in seconds) the shutter takes to switch, once asked to. Scheduled switches are started that much earlier, or by the delay of the slowest shutter switched along with it (see PAWS.get_lead). See PAWS.calibrate. Defaults to 0.
+        hold <bool>: whether to keep the motor engaged during whole shutterings, instead of engaging it for each move. Defaults to False.
+        holding_current <float>: current limit (in A) of the motor while it is held between moves, on boards that support current limits. None to keep the current unchanged. Defaults to None.
+        velocity <float>: velocity limit of the motor's moves, in positions (1/2 steps on the 1062) per second. See Shutter.tune. None to keep the board's. Defaults to None.
+        acceleration <float>: acceleration of the motor's moves, in positions (1/2 steps on the 1062) per second². See Shutter.tune. None to keep the board's. Defaults to None.
+        current <float>: current limit (in A) of the motor's moves. None to keep the board's. Defaults to None.
+        gui <GUI>: Associated GUI, told of state changes
+        motor <int>: motor as indicated on the Phidgets board, when it is not the ID of the shutter, such as on the boards of a Pool after the first one. Defaults to the ID.
     """
 
-    def __init__(self, hardware, ID, step, angle, direction, state=True, gui=None):
-        """Activate the hardware."""
-        # A. Initiate the thread
-        threading.Thread.__init__(self)
+    def __init__(self, controller, ID, step, angle, direction, state=True, delay=0, hold=False, holding_current=None, velocity=None, acceleration=None, current=None, gui=None, motor=None):
+        """Configure the motor."""
+        self.controller, self.id, self.step, self.angle, self.direction, self.state, self.delay, self.gui = controller, ID, step, angle, direction, state, delay, gui
+        self.motor = ID if motor is None else motor
 
-        # B. Configure the motor
-        self.hardware, self.id, self.step, self.angle, self.direction, self.state, self.gui = hardware, ID, step, angle, direction, state, gui
-        self.activate = threading.Event()
+        # State the shutter will be in once the switches requested are done.
+        self.next_state = state
+        self.hold, self.holding_current = hold, holding_current
+        self.hardware = controller.hardware
+        self.clock = controller.clock
 
-        # C. Set a kill switch
-        self.kill = threading.Event()
+        # Whether the motor is powered, and kept powered between moves. When held at a reduced current, the current used for moves, read from the board if it is not given.
+        self.engaged = False
+        self.held = False
+        self.current = current
 
-        # D. Define the waiting times for the running loop.
-        self.kill_wait = 0.5
-        self.activate_wait = 2
-        self.moving_wait = 0.1
+        # Motion profile, sent to the board before the next move once it is changed.
+        self.velocity, self.acceleration = velocity, acceleration
+        self.profiled = False
 
-    def run(self):
-        """Wait for a switching event or death."""
-        while self.kill.wait(self.kill_wait) != True:
-            if self.activate.wait(self.activate_wait) is True:
-                self.switch()
+        # Durations of the steps of the last switches, and start of the current ones.
+        self.timings = Timings(['engage', 'move', 'disengage'])
+        self.engage_time = None
+        self.move_start = None
+
+    def activate(self):
+        """Ask for the motor to be switched, without waiting for it to be done. Return the Move."""
+        return self.controller.switch([self])
 
     def switch(self):
-        """Switch the position of the motor."""
-        # A. Define the target position
+        """Switch the position of the motor and wait for it to be done."""
+        self.activate().wait()
+
+    def get_target(self):
+        """Return the position of the motor in the other state."""
         target = int(round(self.angle / self.step * 2, 0))
         if self.state != self.direction:
             target *= -1
-        p = self.hardware.getCurrentPosition(self.id)
-        target = p + target
-
-        # B. Go there
-        self.hardware.setEngaged(self.id, True)
-        self.hardware.setTargetPosition(self.id, target)
-        while p != target:
-            time.sleep(self.moving_wait)
-            p = self.hardware.getCurrentPosition(self.id)
-        self.hardware.setEngaged(self.id, False)
-
-        # C. Confirm movement
+        return self.hardware.get_position(self.motor) + target
+
+    def engage(self):
+        """Power the motor, or restore its current if it is held, before moving it."""
+        t = self.clock.now()
+        if self.profiled is False:
+            self.send_profile()
+        if self.engaged is False:
+            self.hardware.setEngaged(self.motor, True)
+            self.engaged = True
+        elif self.held is True and self.holding_current is not None:
+            self.hardware.setCurrentLimit(self.motor, self.current)
+        self.engage_time = self.clock.now() - t
+
+    def disengage(self):
+        """Release the motor, or lower its current if it is held, after moving it."""
+        if self.held is False:
+            self.hardware.setEngaged(self.motor, False)
+            self.engaged = False
+        elif self.holding_current is not None:
+            self.hardware.setCurrentLimit(self.motor, self.holding_current)
+
+    def set_held(self, held):
+        """Keep the motor engaged between moves, or release it (called by the MotionController while the motor is not moving)."""
+        if held is True and self.held is False:
+            if self.holding_current is not None and self.current is None:
+                self.current = self.hardware.getCurrentLimit(self.motor)
+            self.engage()
+            self.held = True
+            self.disengage()
+        elif held is False and self.held is True:
+            self.engage()
+            self.held = False
+            self.disengage()
+
+    def set_profile(self, velocity, acceleration):
+        """Use <velocity> and <acceleration> for the next moves. They are sent to the board by the MotionController, right before the next move."""
+        self.velocity, self.acceleration = velocity, acceleration
+        self.profiled = False
+
+    def send_profile(self):
+        """Send the motion profile and current of the motor to the board, for the ones that are set."""
+        if self.velocity is not None:
+            self.hardware.setVelocityLimit(self.motor, self.velocity)
+        if self.acceleration is not None:
+            self.hardware.setAcceleration(self.motor, self.acceleration)
+        if self.current is not None and self.held is False:
+            self.hardware.setCurrentLimit(self.motor, self.current)
+        self.profiled = True
+
+    def tune(self, velocities, accelerations, repeats=3, margin=0.8):
+        """
+        Find the motion profile that switches the shutter the fastest without the motor skipping steps, and use it.
+
+        The <accelerations> are tried from the highest, each with the <velocities> from the highest, until one does not skip steps: for each, the shutter is switched back and forth <repeats> times. After a stall, the motor is brought back to where it was with the lowest profile. The fastest profile found is lowered by <margin>, to leave room for the load and wear of the motor, then measured again and kept. Skipped steps are only seen on boards with position feedback (see MotionController). The shutter must not be moving nor held, and is left in its state. Its delay is left as it is: calibrate it again (see PAWS.tune). Return the velocity, acceleration and median switch duration kept, or None if every profile skipped steps.
+        """
+        velocities, accelerations = sorted(velocities, reverse=True), sorted(accelerations, reverse=True)
+        slowest = (velocities[-1], accelerations[-1])
+        best = None
+        for acceleration in accelerations:
+            for velocity in velocities:
+                duration = self.try_profile(velocity, acceleration, repeats, slowest)
+                if duration is not None:
+                    if best is None or duration < best[2]:
+                        best = (velocity, acceleration, duration)
+                    break
+        if best is None:
+            self.set_profile(*slowest)
+            return None
+        velocity, acceleration = best[0] * margin, best[1] * margin
+        duration = self.try_profile(velocity, acceleration, repeats, slowest)
+        if duration is None:
+            self.set_profile(*slowest)
+            return None
+        return velocity, acceleration, duration
+
+    def try_profile(self, velocity, acceleration, repeats, slowest):
+        """Switch the shutter back and forth <repeats> times with the profile. Return the median duration of the moves, or None if the motor skipped steps, after bringing it back with the <slowest> profile."""
+        self.set_profile(velocity, acceleration)
+        position, state = self.hardware.get_position(self.motor), self.state
+        durations = list()
+        for k in range(2 * repeats):
+            move = self.activate()
+            move.wait()
+            if move.error is not None:
+                raise move.error
+            if self.id in move.stalled:
+                self.recover(position, state, slowest)
+                return None
+            durations.append(move.done[self.id] - move.started[self.id])
+        return sorted(durations)[len(durations) // 2]
+
+    def recover(self, position, state, profile, tries=10):
+        """Bring the motor back to <position>, in <state>, with the <profile> (velocity, acceleration), after it skipped steps. The MotionController must not be moving it. Raise a RuntimeError if it does not get there in <tries> tries."""
+        self.set_profile(*profile)
+        self.send_profile()
+        self.hardware.setEngaged(self.motor, True)
+        try:
+            for k in range(tries):
+                self.hardware.setTargetPosition(self.motor, position)
+                while self.hardware.getStopped(self.motor) is False:
+                    self.clock.sleep(self.controller.moving_wait)
+                self.hardware.positions[self.motor] = self.hardware.getCurrentPosition(self.motor)
+                if self.hardware.positions[self.motor] == position:
+                    break
+            else:
+                raise RuntimeError('Shutter {0} could not be brought back to position {1}.'.format(self.id, position))
+        finally:
+            self.hardware.setEngaged(self.motor, False)
+        self.state = self.next_state = state
+        if self.gui is not None:
+            self.gui.shutter_switched(self)
+
+    def start_move(self, target):
+        """Send the engaged motor to <target>."""
+        self.move_start = self.clock.now()
+        self.hardware.setTargetPosition(self.motor, target)
+
+    def end_move(self):
+        """Confirm the switch once the motor reached its target, and release the motor."""
+        # A. Confirm movement, even if the motor cannot be released
         self.state = not self.state
-        self.activate.clear()
 
-        # D. Update GUI
+        # B. Update GUI
         if self.gui is not None:
-            GLib.idle_add(self.gui.set_active, self.state)
+            self.gui.shutter_switched(self)
+
+        # C. Release the motor
+        t = self.clock.now()
+        self.disengage()
+        self.timings.add(self.engage_time, t - self.move_start, self.clock.now() - t)
 
     def set_state(self, state):
         """Set the shutter in the given state (True = Closed / False = Opened)."""
@@ -156,20 +1572,144 @@ class Shutter(threading.Thread):
         return {'step': self.step,
                 'angle': self.angle,
                 'direction': self.direction,
-                'state': self.state}
+                'state': self.state,
+                'delay': self.delay,
+                'hold': self.hold,
+                'holding_current': self.holding_current,
+                'velocity': self.velocity,
+                'acceleration': self.acceleration,
+                'current': self.current}
 
-    def stop(self):
-        """Stop the thread."""
-        self.kill.set()
 
+class Board(object):
+    """
+    Common layer of the Phidgets stepper boards, real (Hardware) or simulated (SimulatedHardware).
+
+    The positions and targets of the motors are modeled from the board's events and the targets sent to it, so that they can be known without querying the board. The model is checked against the board on request (see Board.check_positions).
 
-class Hardware(Stepper):
-    """Activate the Phidgets controller board (1062_1)."""
+    The board's events are forwarded to the listeners, through their motor_moved(motor id, position) and motor_stopped(motor id) methods.
+
+    The calls to the board that go through USB are counted, by method, in self.calls.
+    """
 
     def __init__(self):
+        """Start the model and listen to the board's events."""
+        self.calls = dict()
+
+        # Model of the motors, as {motor id: position}, and drift of the model found at the last check.
+        self.positions = dict()
+        self.targets = dict()
+        self.drift = dict()
+
+        # Forward the motors' events to the objects listening to them.
+        self.listeners = list()
+        self.setOnPositionChangeHandler(self.position_changed)
+        self.setOnVelocityChangeHandler(self.velocity_changed)
+
+    def get_position(self, i):
+        """Return the position of motor <i> from the model, reading it from the board if it is unknown."""
+        if i not in self.positions:
+            self.positions[i] = self.getCurrentPosition(i)
+        return self.positions[i]
+
+    def count(self, call):
+        """Count a <call> to the board."""
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def setTargetPosition(self, i, target):
+        """Send motor <i> to <target>, and keep it in the model."""
+        self.count('setTargetPosition')
+        self.targets[i] = target
+        super(Board, self).setTargetPosition(i, target)
+
+    def getCurrentPosition(self, i):
+        """Read the position of motor <i> from the board."""
+        self.count('getCurrentPosition')
+        return super(Board, self).getCurrentPosition(i)
+
+    def setEngaged(self, i, engaged):
+        """Power motor <i> or release it."""
+        self.count('setEngaged')
+        super(Board, self).setEngaged(i, engaged)
+
+    def getStopped(self, i):
+        """Read whether motor <i> is stopped from the board."""
+        self.count('getStopped')
+        return super(Board, self).getStopped(i)
+
+    def getVelocityLimit(self, i):
+        """Read the velocity limit of motor <i> from the board."""
+        self.count('getVelocityLimit')
+        return super(Board, self).getVelocityLimit(i)
+
+    def setVelocityLimit(self, i, velocity):
+        """Set the velocity limit of motor <i>, for its next moves."""
+        self.count('setVelocityLimit')
+        super(Board, self).setVelocityLimit(i, velocity)
+
+    def getAcceleration(self, i):
+        """Read the acceleration of motor <i> from the board."""
+        self.count('getAcceleration')
+        return super(Board, self).getAcceleration(i)
+
+    def setAcceleration(self, i, acceleration):
+        """Set the acceleration of motor <i>, for its next moves."""
+        self.count('setAcceleration')
+        super(Board, self).setAcceleration(i, acceleration)
+
+    def getCurrentLimit(self, i):
+        """Read the current limit of motor <i> from the board."""
+        self.count('getCurrentLimit')
+        return super(Board, self).getCurrentLimit(i)
+
+    def setCurrentLimit(self, i, current):
+        """Set the current limit of motor <i>."""
+        self.count('setCurrentLimit')
+        super(Board, self).setCurrentLimit(i, current)
+
+    def check_positions(self):
+        """
+        Compare the model with the positions read from the board, while no motor is moving, and correct it.
+
+        Return the drift of the model, as {motor id: position on the board - position in the model}, for the motors where they differ.
+        """
+        drift = dict()
+        for i in range(self.getMotorCount()):
+            position = self.getCurrentPosition(i)
+            if i in self.positions and self.positions[i] != position:
+                drift[i] = position - self.positions[i]
+            self.positions[i] = position
+        if len(drift) > 0:
+            logger.warning('Motor positions drifted from the model: %s', drift)
+        self.drift = drift
+        return drift
+
+    def position_changed(self, e):
+        """Update the model and tell the listeners that a motor moved."""
+        self.positions[e.index] = e.position
+        for listener in self.listeners:
+            listener.motor_moved(e.index, e.position)
+
+    def velocity_changed(self, e):
+        """Tell the listeners that a motor stopped."""
+        if e.velocity == 0:
+            for listener in self.listeners:
+                listener.motor_stopped(e.index)
+
+
+class Hardware(Board, Stepper):
+    """
+    Activate the Phidgets controller board (1062_1).
+
+    Arguments:
+        serial <int>: serial number of the board to open. Defaults to -1, for the first one found.
+    """
+
+    def __init__(self, serial=-1):
         """Activate the hardware."""
         Stepper.__init__(self)
-        self.openPhidget()
+        Board.__init__(self)
+        self.openPhidget(serial)
         self.waitForAttach(1000)
 
     def __del__(self):
@@ -179,277 +1719,374 @@ class Hardware(Stepper):
     stop = __del__
 
 
-class FakeHardware(object):
-    """Useful for debugging GUI when no hardware is plugged in."""
+class SimulatedEvent(object):
+    """Arguments of the events of a SimulatedStepper, like the ones of Phidgets' events."""
 
-    def getMotorCount(self):
-        """Lies."""
-        return 4
+    def __init__(self, device, index, **values):
+        """Store the values."""
+        self.device, self.index = device, index
+        self.__dict__.update(values)
 
 
-class GUI(Gtk.Builder):
-    """Graphical User Interface for interacting with a PAWS."""
+class SimulatedStepper(object):
+    """
+    Stand-in for the Phidgets Stepper, for running PAWS without a board.
 
-    #
-    # GUI related methods
-    #
-    def __init__(self, paws, gui_file="GUI.glade", *args):
-        """Initiate the parent objects and do basic definitions."""
-        # Connect the GUI to handlers
-        Gtk.Builder.__init__(self)
-        self.add_from_file(gui_file)
-        self.connect_signals(self)
-
-        # Connect to PAWS
-        self.paws = paws
-
-        # Times per second the progress is updated
-        self.update_frequency = 0.1
-
-    def show_settings_if_need_be(self):
-        """Decide whether to show the Settings panel at start."""
-        if self.paws.shutters is None:
-            self.get_object('settings_window').show_all()
-
-    def start(self):
-        """Start the GUI."""
-        # No Hardware, no GUI.
-        if self.paws.hardware is None:
-            window = self.get_object('no_hardware')
-            window.show_all()
-        else:
-            window = self.get_object('paws')
-            window.show_all()
-            self.update_gui_settings()
-            self.show_settings_if_need_be()
-            self.load_shuttering_parameters()
+    Engaged motors move to their target with a trapezoidal velocity profile. Every call to the board takes "usb_latency" seconds. While motors move, their position is reported every "event_interval" seconds and when they reach their target, followed by a velocity change to 0, like the real board does. Events are sent from the simulation's own thread.
 
-        Gtk.main()
+    Arguments:
+        motors <int>: number of motors on the board. Defaults to 4.
+        velocity <float>: velocity limit of the motors, in positions (1/2 steps on the 1062) per second. Defaults to 383.25, the maximum of the 1062 board.
+        acceleration <float>: acceleration of the motors, in positions per second squared. Defaults to 8859.375, the maximum of the 1062 board.
+        usb_latency <float>: time (in seconds) each call to the board takes. Defaults to 0.001.
+        event_interval <float>: time (in seconds) between two position changes reported for a moving motor. Defaults to 0.008.
+        serial <int>: serial number of the board. Defaults to 0.
+        clock <Clock>: time of the simulation. With a VirtualClock, moves and calls to the board take no real time. Defaults to the real time.
+        stall <tuple>: (velocity, acceleration) above which the motors skip steps, as motors driving a heavy load do, or None for motors that never do. It can be set for each motor in self.motors[i]['stall']. Defaults to None.
+
+    Motors that skip steps stop short of their target, by the fraction of the move their velocity or acceleration is above what they can drive, and report the position they stopped at, as a board with position feedback would.
+    """
 
-    def close(self, *args):
-        """Stop the GUI."""
-        self.save_shuttering_parameters()
-        self.paws.gui = None
-        Gtk.main_quit(*args)
+    # Maximum velocity and acceleration of the motors of the 1062 board.
+    velocity_max = 383.25
+    acceleration_max = 8859.375
+
+    def __init__(self, motors=4, velocity=383.25, acceleration=8859.375, usb_latency=0.001, event_interval=0.008, serial=0, clock=None, stall=None):
+        """Build the motors."""
+        self.usb_latency, self.event_interval, self.serial = usb_latency, event_interval, serial
+        self.clock = Clock() if clock is None else clock
+        self.motors = [{'engaged': False, 'position': 0, 'target': 0, 'start': None, 'reported': 0,
+                        'velocity': velocity, 'acceleration': acceleration, 'current': 0, 'stall': stall}
+                       for i in range(motors)]
+        self.handlers = {'position': None, 'velocity': None}
+        self.condition = Wakeup()
+        self.attached = False
+        self.thread = None
 
     #
-    # Shuttering related methods
+    # Simulation
     #
-    def get_shuttering_parameters(self):
-        """Return the shuttering parameters from the GUI."""
-        loops = self.get_object("loops").get_value()
-        loops_units = self.get_object("loops_units").get_active()
-        wait = self.get_object("wait").get_value()
-        wait_units = self.get_object("wait_units").get_active()
-        return loops, loops_units, wait, wait_units
-
-    def get_converted_shuttering_parameters(self):
-        """Get the shuttering parameters from the GUI and return them in loops and seconds for the PAWS.shutter() function."""
-        loops, loops_u, wait, wait_u = self.get_shuttering_parameters()
-        convert = {0: 1, 1: 60, 2: 60**2}
-        wait = wait * convert[wait_u]
-        if loops_u != 0:
-            loops = ceil(loops * convert[loops_u - 1] / wait)
-        loops = int(loops)
-        return loops, wait
-
-    def start_shutter(self, *args):
-        """Start shuttering via GUI."""
-        self.get_object("shutter_stop").show()
-        self.get_object("shutter_back").hide()
-        self.show_shutter_progress()
-        self.loops, self.wait = self.get_converted_shuttering_parameters()
-        self.paws.shutter(self.loops, self.wait)
-
-    def stop_shutter(self, *args):
-        """Stop shuttering via GUI."""
-        self.paws.stop_shutter()
-        self.loops = None
-        self.wait = None
-        self.get_object("shutter_stop").hide()
-        self.get_object("shutter_back").show()
-
-    def show_shutter_parameters(self, *args):
-        """Go to the shuttering parameters panel."""
-        self.get_object("shutter").set_visible_child_name('parameters')
-
-    def show_shutter_progress(self, *args):
-        """Go to the shuttering progress panel."""
-        self.get_object("shutter").set_visible_child_name('progress')
-
-    def update_shuttering_progress(self, loop, t):
-        """Update the progress bars for shuttering."""
-        # Adjust text.
-        loops_text = "Alternation {0}/{1}".format(loop, self.loops)
-        wait_text = "{0} seconds before next alternation".format(self.wait - t)
-
-        # Shuttering is done?
-        if t == self.wait and loop == self.loops:
-            wait_text = "Done."
-            loops_text = "Done. ({0}/{1})".format(loop, self.loops)
-            GLib.idle_add(self.get_object("shutter_stop").hide)
-            GLib.idle_add(self.get_object("shutter_back").show)
-
-        # Send all of it to the GUI (we're it the TimeKeeper thread, here.)
-        GLib.idle_add(self.get_object('progress_loops').set_fraction, loop / self.loops)
-        GLib.idle_add(self.get_object('progress_loops').set_text, loops_text)
-        GLib.idle_add(self.get_object('progress_wait').set_fraction, t / self.wait)
-        GLib.idle_add(self.get_object('progress_wait').set_text, wait_text)
-
-    def save_shuttering_parameters(self):
-        """Save the shuttering parameters in the PAWS object."""
-        if 'gui_settings' not in vars(self.paws):
-            self.paws.gui_settings = dict()
-        self.paws.gui_settings['shuttering'] = self.get_shuttering_parameters()
-
-    def load_shuttering_parameters(self):
-        """Load shuttering parameters saved in the PAWS object."""
-        if 'gui_settings' in vars(self.paws) and 'shuttering' in self.paws.gui_settings.keys():
-            loops, loops_u, wait, wait_u = self.paws.gui_settings['shuttering']
-            self.get_object('loops').set_value(loops)
-            self.get_object('loops_units').set_active(loops_u)
-            self.get_object('wait').set_value(wait)
-            self.get_object('wait_units').set_active(wait_u)
+    def get_profile(self, m):
+        """Return the distance, peak velocity, acceleration time and total time of the move of motor <m>."""
+        distance = abs(m['target'] - m['position'])
+        v, a = m['velocity'], m['acceleration']
+        t_acc = v / a
+        if distance < v * t_acc:
+            t_acc = (distance / a) ** 0.5
+            v = a * t_acc
+        t_total = 2 * t_acc + (distance - v * t_acc) / v if v > 0 else 0
+        return distance, v, t_acc, t_total
+
+    def get_simulated_position(self, m, t):
+        """Return the position of motor <m> at time <t>."""
+        if m['start'] is None:
+            return m['position']
+        distance, v, t_acc, t_total = self.get_profile(m)
+        a, tau = m['acceleration'], t - m['start']
+        if tau >= t_total:
+            x = distance
+        elif tau < t_acc:
+            x = a * tau ** 2 / 2
+        elif tau < t_total - t_acc:
+            x = v * t_acc / 2 + v * (tau - t_acc)
+        else:
+            x = distance - a * (t_total - tau) ** 2 / 2
+        return m['position'] + int(x) * (1 if m['target'] >= m['position'] else -1)
+
+    def get_reach(self, m, target):
+        """Return the position the stopped motor <m> reaches when sent to <target>: short of it if it skips steps (see SimulatedStepper)."""
+        if m['stall'] is None:
+            return target
+        velocity, acceleration = m['stall']
+        ratio = min(1, velocity / m['velocity'], acceleration / m['acceleration'])
+        lost = int(abs(target - m['position']) * (1 - ratio))
+        return target - lost if target >= m['position'] else target + lost
+
+    def freeze(self, m):
+        """Stop the simulated move of motor <m> where it is now. The caller must hold self.condition."""
+        m['position'] = self.get_simulated_position(m, self.clock.now())
+        m['start'] = None
+
+    def resume(self, m):
+        """Start the simulated move of motor <m> towards its target, if it can move. The caller must hold self.condition."""
+        if m['engaged'] is True and m['position'] != m['target']:
+            m['start'] = self.clock.now()
+            self.condition.notify()
+
+    def simulate(self):
+        """Move the motors and send their events."""
+        with self.condition:
+            while self.attached is True:
+                now = self.clock.now()
+                events = list()
+                timeout = None
+                for i, m in enumerate(self.motors):
+                    if m['start'] is None:
+                        continue
+                    position = self.get_simulated_position(m, now)
+                    if position != m['reported']:
+                        m['reported'] = position
+                        events.append(('position', SimulatedEvent(self, i, position=position)))
+                    if position == m['target']:
+                        m['position'], m['start'] = position, None
+                        events.append(('velocity', SimulatedEvent(self, i, velocity=0)))
+                    else:
+                        end = m['start'] + self.get_profile(m)[3] - now
+                        timeout = min([t for t in (timeout, self.event_interval, end) if t is not None])
+
+                # Wait for the next event, or send the events without locking the board, and look at the motors again as they may have been moved meanwhile.
+                if len(events) == 0:
+                    self.clock.wait(self.condition, timeout)
+                    continue
+                self.condition.release()
+                try:
+                    for kind, event in events:
+                        if self.handlers[kind] is not None:
+                            self.handlers[kind](event)
+                finally:
+                    self.condition.acquire()
+        self.clock.leave()
+
+    def call(self):
+        """Simulate the time a call to the board takes."""
+        if self.usb_latency > 0:
+            self.clock.sleep(self.usb_latency)
 
     #
-    # Settings related methods
+    # Stepper interface
     #
-    def show_settings(self, *args):
-        """Open the settings window."""
-        self.get_object('settings_window').show()
-
-    def close_settings(self, *args):
-        """Close the settings window."""
-        self.get_object('settings_window').hide()
-
-    def get_shutter_settings_widgets(self, i):
-        """Return widgets for shutter <i>."""
-        settings = self.get_object("settings_shutters")
-        widgets = {
-            'active': settings.get_child_at(i + 1, 1),
-            'name': settings.get_child_at(i + 1, 2),
-            'step': settings.get_child_at(i + 1, 3),
-            'angle': settings.get_child_at(i + 1, 4),
-            'direction': settings.get_child_at(i + 1, 5),
-            'state': settings.get_child_at(i + 1, 6),
-        }
-        return widgets
-
-    def switch_shutter_settings_widgets(self, *args):
-        """Hide/Show the settings for the given shutter."""
-        active = args[0].get_active()
-        widgets = self.get_shutter_settings_widgets(self.get_object("settings_shutters").child_get_property(args[0], 'left-attach') - 1)
-        for k, v in widgets.items():
-            if k != 'active':
-                if active:
-                    v.show()
-                else:
-                    v.hide()
+    def openPhidget(self, serial=-1):
+        """Start the simulation."""
+        with self.condition:
+            if self.attached is False:
+                self.attached = True
+                self.thread = threading.Thread(target=self.simulate)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def waitForAttach(self, timeout):
+        """Return at once: the simulated board is always attached."""
+        pass
+
+    def closePhidget(self):
+        """Stop the simulation."""
+        with self.condition:
+            self.attached = False
+            self.condition.notify()
+
+    def isAttached(self):
+        """Return whether the simulation is running."""
+        return self.attached
+
+    def getSerialNum(self):
+        """Return the serial number of the board."""
+        return self.serial
 
-    def update_paws_settings(self, *args):
-        """Update the settings in PAWS using the settings in the GUI."""
-        # Update general settings
-        self.update_frequency = self.get_object('update_frequency').get_value()
-        self.paws.todo.precision = self.get_object('precision').get_value()
+    def getMotorCount(self):
+        """Return the number of motors."""
+        return len(self.motors)
+
+    def getInputCount(self):
+        """Return the number of digital inputs."""
+        return 0
+
+    def setOnPositionChangeHandler(self, handler):
+        """Call <handler>(event) when a motor's position changes."""
+        self.handlers['position'] = handler
+
+    def setOnVelocityChangeHandler(self, handler):
+        """Call <handler>(event) when a motor stops."""
+        self.handlers['velocity'] = handler
+
+    def getEngaged(self, i):
+        """Return whether motor <i> is powered."""
+        self.call()
+        return self.motors[i]['engaged']
+
+    def setEngaged(self, i, engaged):
+        """Power motor <i>, or release it."""
+        self.call()
+        with self.condition:
+            m = self.motors[i]
+            self.freeze(m)
+            m['engaged'] = engaged
+            self.resume(m)
+
+    def getCurrentPosition(self, i):
+        """Return the position of motor <i>."""
+        self.call()
+        with self.condition:
+            return self.get_simulated_position(self.motors[i], self.clock.now())
+
+    def setCurrentPosition(self, i, position):
+        """Set the position of the stopped motor <i> to <position>, without moving it."""
+        self.call()
+        with self.condition:
+            m = self.motors[i]
+            m['position'] = m['target'] = m['reported'] = position
+
+    def getTargetPosition(self, i):
+        """Return the target of motor <i>."""
+        self.call()
+        return self.motors[i]['target']
+
+    def setTargetPosition(self, i, target):
+        """Send motor <i> to <target>."""
+        self.call()
+        with self.condition:
+            m = self.motors[i]
+            self.freeze(m)
+            m['target'] = self.get_reach(m, target)
+            self.resume(m)
+
+    def getStopped(self, i):
+        """Return whether motor <i> is not moving."""
+        self.call()
+        return self.motors[i]['start'] is None
+
+    def getVelocityLimit(self, i):
+        """Return the velocity limit of motor <i>."""
+        self.call()
+        return self.motors[i]['velocity']
+
+    def getVelocityMax(self, i):
+        """Return the highest velocity limit motor <i> can be given."""
+        return self.velocity_max
+
+    def getAccelerationMax(self, i):
+        """Return the highest acceleration motor <i> can be given."""
+        return self.acceleration_max
+
+    def setVelocityLimit(self, i, velocity):
+        """Set the velocity limit of motor <i>, for its next moves."""
+        self.call()
+        self.motors[i]['velocity'] = velocity
+
+    def getAcceleration(self, i):
+        """Return the acceleration of motor <i>."""
+        self.call()
+        return self.motors[i]['acceleration']
+
+    def setAcceleration(self, i, acceleration):
+        """Set the acceleration of motor <i>, for its next moves."""
+        self.call()
+        self.motors[i]['acceleration'] = acceleration
+
+    def getCurrentLimit(self, i):
+        """Return the current limit of motor <i>."""
+        self.call()
+        return self.motors[i]['current']
+
+    def setCurrentLimit(self, i, current):
+        """Set the current limit of motor <i>."""
+        self.call()
+        self.motors[i]['current'] = current
+
+
+class SimulatedHardware(Board, SimulatedStepper):
+    """
+    Simulated Phidgets controller board, for running and benchmarking PAWS when no hardware is plugged in.
 
-        # Put the GUI-specific settings in the PAWS object for saving them.
-        self.paws.gui_settings = {
-            'update_frequency': self.update_frequency,
-            'shutter_names': {0: "0", 1: "1", 2: "2", 3: "3"}
-        }
+    Arguments: see SimulatedStepper.
+    """
 
-        # Update Shutters settings
-        shutters = dict()
-        if self.paws.hardware is not None:
-            for i in range(self.paws.hardware.getMotorCount()):
-                widgets = self.get_shutter_settings_widgets(i)
-                if widgets['active'].get_active() == True:
-                    shutters[i] = dict()
-                    shutters[i]['step'] = widgets['step'].get_value()
-                    shutters[i]['angle'] = widgets['angle'].get_value()
-                    shutters[i]['direction'] = widgets['direction'].get_active()
-                    shutters[i]['state'] = widgets['state'].get_active()
-                    self.paws.gui_settings["shutter_names"][i] = widgets['name'].get_text()
-        if len(shutters) == 0:
-            shutters = None
-        self.paws.setup_shutters(shutters)
-
-        # Update switches
-        self.pair_shutter_switches()
-
-    def update_gui_settings(self, *args):
-        """Update the settings in the GUI using the settings from PAWS."""
-        # Update Shutters settings
-        if self.paws.shutters is not None:
-            for i in range(self.paws.hardware.getMotorCount()):
-                widgets = self.get_shutter_settings_widgets(i)
-                if i in self.paws.shutters.keys():
-                    shutter = self.paws.shutters[i]
-                    widgets['step'].set_value(shutter.step)
-                    widgets['angle'].set_value(shutter.angle)
-                    widgets['direction'].set_active(shutter.direction)
-                    widgets['state'].set_active(shutter.state)
-                    widgets['name'].set_text(self.paws.gui_settings['shutter_names'][i])
-                else:
-                    widgets['active'].set_active(False)
+    def __init__(self, *args, **kwargs):
+        """Activate the simulated hardware."""
+        SimulatedStepper.__init__(self, *args, **kwargs)
+        Board.__init__(self)
+        self.openPhidget()
+        self.waitForAttach(1000)
 
-        # Update switches
-        self.pair_shutter_switches()
+    def stop(self):
+        """Stop the simulated hardware."""
+        self.closePhidget()
 
-        # Load the GUI-specific settings from the PAWS object
-        if 'gui_settings' in vars(self.paws):
-            self.update_frequency = self.paws.gui_settings['update_frequency']
 
-        # Update the general settings
-        self.get_object('update_frequency').set_value(self.update_frequency)
-        self.get_object('precision').set_value(self.paws.todo.precision)
+class Pool(object):
+    """
+    Several boards used as one, with one global id for each motor: the motors of the first board come first, then the motors of the second one, and so on.
 
-    #
-    # Shutter switches related methods
-    #
-    def get_shutter_switch(self, i):
-        """Return widgets for shutter <i>."""
-        return self.get_object("switches").get_child_at(i, 0).get_children()[1]
-
-    def get_shutter_switchbox(self, i):
-        """Return the Box containing Switch and Label of shutter <i>."""
-        return self.get_object("switches").get_child_at(i, 0)
-
-    def switch_shutter_state(self, *args):
-        """Switch the physical state of a shutter from a GUI call."""
-        for s in self.paws.shutters.values():
-            if s.gui == args[0]:
-                s.switch()
-
-    def pair_shutter_switches(self):
-        """Update the switches to match current settings and associate the GUI to the shutters."""
-        if self.paws.shutters is not None:
-            self.get_object('switches').show()
-            self.get_object('no_shutters').hide()
-            for i in range(self.paws.hardware.getMotorCount()):
-                if i in self.paws.shutters.keys():
-                    shutter = self.paws.shutters[i]
-                    switch = self.get_shutter_switch(i)
-                    box = self.get_shutter_switchbox(i)
-
-                    # Switch visibility
-                    box.show()
-                    switch.set_active(shutter.state)
-
-                    # Add GUI to the shutter
-                    if shutter.gui is None:
-                        shutter.gui = switch
-
-                    # Setup the shutter's name
-                    box.get_children()[0].set_text(self.get_shutter_settings_widgets(i)['name'].get_text())
-
-                    # Sync state
-                    switch.set_state(shutter.state)
-                else:
-                    self.get_shutter_switchbox(i).hide()
+    Arguments:
+        boards <list>: opened boards (Hardware or SimulatedHardware objects), in the order of the ids
+    """
+
+    def __init__(self, boards):
+        """Number the motors of the <boards>."""
+        self.boards = list(boards)
+        self.offsets = list()
+        offset = 0
+        for board in self.boards:
+            self.offsets.append(offset)
+            offset += board.getMotorCount()
+
+    @classmethod
+    def open(cls, serials=None, simulate=False):
+        """
+        Open the boards with the given serial numbers, and return them as a Pool, or the board itself if there is only one.
+
+        Arguments:
+            serials <list>: serial numbers of the boards, in the order of the ids. Defaults to None, for all the attached stepper boards, by serial number.
+            simulate <bool>: whether to use SimulatedHardware boards with these serial numbers, one if there are none. Defaults to False.
+        """
+        if simulate is True:
+            boards = [SimulatedHardware(serial=serial) for serial in (serials if serials else [0])]
         else:
-            self.get_object('switches').hide()
-            self.get_object('no_shutters').show()
+            serials = cls.find_serials() if serials is None else serials
+            boards = [Hardware(serial) for serial in (serials if len(serials) > 0 else [-1])]
+        return boards[0] if len(boards) == 1 else cls(boards)
+
+    @staticmethod
+    def find_serials(timeout=0.5, settle=0.05):
+        """Return the serial numbers of the Phidgets stepper boards attached to the computer, sorted, once no other board has shown up for <settle> seconds after the first one, or after <timeout> seconds if there are none. Return an empty list if they cannot be listed."""
+        try:
+            from Phidgets.Manager import Manager
+            from Phidgets.Phidget import PhidgetClass
+        except ImportError:
+            return list()
+        attached = threading.Event()
+
+        def attach(e):
+            """Tell that a stepper board showed up."""
+            if e.device.getDeviceClass() == PhidgetClass.STEPPER:
+                attached.set()
+            return 0
+
+        manager = Manager()
+        manager.setOnAttachHandler(attach)
+        manager.openManager()
+        try:
+            # The boards already attached show up one after the other as soon as the manager is opened.
+            deadline = monotonic() + timeout
+            attached.wait(timeout)
+            while attached.is_set() and monotonic() < deadline:
+                attached.clear()
+                attached.wait(min(settle, deadline - monotonic()))
+            return sorted([d.getSerialNum() for d in manager.getAttachedDevices() if d.getDeviceClass() == PhidgetClass.STEPPER])
+        finally:
+            manager.closeManager()
+
+    def locate(self, i):
+        """Return the board (as an index in self.boards) and the motor on that board of the global motor id <i>. Raise a ValueError if there is no such motor."""
+        for board in reversed(range(len(self.boards))):
+            if i >= self.offsets[board]:
+                motor = i - self.offsets[board]
+                if motor < self.boards[board].getMotorCount():
+                    return board, motor
+                break
+        raise ValueError("There is no motor {0} on the boards.".format(i))
+
+    def getMotorCount(self):
+        """Return the number of motors of all the boards."""
+        return sum([board.getMotorCount() for board in self.boards])
+
+    def getSerialNum(self):
+        """Return the serial numbers of the boards."""
+        return [board.getSerialNum() for board in self.boards]
+
+    def stop(self):
+        """Stop all the boards."""
+        for board in self.boards:
+            board.stop()
 
 
 class PAWS(object):
@@ -462,25 +2099,49 @@ class PAWS(object):
         id: {step, angle, direction, state}
         See the doc from Shutter for explanation of each parameter.
     precision <float>: see TimeKeeper
+    hardware: Board to use, such as a SimulatedHardware, or Pool of boards. If None, all the attached Phidgets boards are opened (see Pool.open).
+    clock <Clock>: time of PAWS, such as a VirtualClock along with a SimulatedHardware using it. Defaults to the real time.
     """
 
-    def __init__(self, settings=None, shutters=None, precision=0.5):
+    def __init__(self, settings=None, shutters=None, precision=0.5, hardware=None, clock=None):
         """Initiate a PAWS."""
         # Start the TimeKeeper
-        self.todo = TimeKeeper(precision)
+        self.clock = Clock() if clock is None else clock
+        self.todo = TimeKeeper(precision, self.clock)
 
         # There are no shutters nor settings, yet.
         self.shutters = None
         self.settings = None
 
         # Try to start the hardware
-        try:
-            self.hardware = Hardware()
-        except Phidgets.PhidgetException.PhidgetException:
-            self.hardware = None
+        self.hardware = hardware
+        if self.hardware is None and Phidgets is not None:
+            try:
+                self.hardware = Pool.open()
+            except Phidgets.PhidgetException.PhidgetException:
+                self.hardware = None
+
+        # Start the motion controller, one for each board of a Pool
+        if isinstance(self.hardware, Pool):
+            self.motion = MotionPool(self.hardware, self.clock)
+        else:
+            self.motion = MotionController(self.hardware, self.clock)
 
-        # There is no GUI, yet
+        # There is no GUI, control socket, transition log nor shuttering, yet. Runs are the timelines of the shutterings and sequences on the TimeKeeper, and paused the time at which they were paused.
         self.gui = None
+        self.server = None
+        self.metrics = None
+        self.log = None
+        self.shuttering = None
+        self.runs = list()
+        self.paused = None
+
+        # Protocols waiting to be run one after the other, and the Run going through them (see PAWS.run_queue).
+        self.protocols = deque()
+        self.queue_run = None
+
+        # Functions called with no arguments when the protocol in progress or the queue changes, from the thread changing them, so they must not block.
+        self.observers = list()
 
         # Load a configuration
         if settings is not None:
@@ -492,47 +2153,334 @@ class PAWS(object):
 
     def start_gui(self):
         """Start the GUI for controlling PAWS."""
+        from gui import GUI
         self.gui = GUI(paws=self)
         self.gui.start()
 
+    def start_server(self, address):
+        """Serve the control socket at <address>, for other programs to drive the shutters (see control.py)."""
+        from control import ControlServer
+        self.server = ControlServer(self, address)
+
+    def start_metrics(self, address):
+        """Serve the metrics of PAWS over HTTP at <address>, "port" or "host:port", for monitoring (see metrics.py)."""
+        from metrics import MetricsServer
+        self.metrics = MetricsServer(self, address)
+
+    def start_log(self, f):
+        """Record the transitions of the shutters in the log file <f> (see TransitionLog)."""
+        self.log = TransitionLog(f, self.clock)
+        self.motion.observers.append(self.log.record)
+
     def setup_shutters(self, shutters):
         """Setup shutters."""
-        # Kill old shutter threads
-        if self.shutters is not None:
-            for s in self.shutters.values():
-                s.stop()
-
-        # Setup new shutters threads
         if shutters is not None:
             s = dict()
             for k, i in shutters.items():
-                s[k] = Shutter(self.hardware, k, **i)
-                s[k].start()
+                controller, motor = self.motion.locate(k)
+                s[k] = Shutter(controller, k, motor=motor, **i)
         else:
             s = None
         self.shutters = s
 
-    def shutter(self, loops, wait):
-        """Alternate the shutters <loops> times, waiting <wait> seconds before each alternation."""
-        t = time.time()
-        for i in range(0, loops):
-            # Switch shutters
-            for shutter in self.shutters.values():
-                self.todo.add(t + (i + 1) * wait, shutter.activate.set)
+    def shutter(self, loops, wait, late='fire'):
+        """Alternate the shutters <loops> times, waiting <wait> seconds before each alternation. <late> tells what to do with late alternations (see TimeKeeper)."""
+        t = self.clock.time()
+        self.start_protocol((t, loops, wait), self.shutters.values())
+        self.add_run(self.shuttering_timeline(t, loops, wait), late)
+
+    def start_protocol(self, shuttering, shutters):
+        """Show the <shuttering> (see PAWS.shuttering; None for a sequence) as the one in progress, and hold the <shutters> set to be held."""
+        self.shuttering = shuttering
+        self.motion.hold([s for s in shutters if s.hold is True])
+        self.changed()
+
+    def start_queued(self, shuttering, shutters):
+        """Start a protocol of the queue (see PAWS.start_protocol), its <shuttering> starting later by the time the queue was delayed by, by pauses and compressed overruns (see Run.shift)."""
+        if shuttering is not None:
+            t, loops, wait = shuttering
+            shuttering = (t + self.queue_run.shift, loops, wait)
+        self.start_protocol(shuttering, shutters)
+
+    def changed(self):
+        """Tell the observers that the protocol in progress or the queue changed."""
+        for observer in self.observers:
+            try:
+                observer()
+            except Exception:
+                logger.exception('An observer of the protocols failed.')
+
+    def get_progress(self):
+        """Return the progress of the shuttering as (number of alternations done, time since the last one), or None if there is no shuttering."""
+        if self.shuttering is None:
+            return None
+        t, loops, wait = self.shuttering
+        elapsed = (self.clock.time() if self.paused is None else self.paused) - t
+        if elapsed >= loops * wait:
+            return loops, wait
+        return int(elapsed // wait), elapsed % wait
+
+    def shuttering_timeline(self, t, loops, wait, states=None):
+        """Yield the events of a shuttering (see PAWS.shutter) started at time <t>, in chronological order, from the <states> of the shutters ({shutter id: state}; the current ones if None)."""
+        lead = self.get_lead(self.shutters.keys())
+        if states is None:
+            states = dict([(i, s.next_state) for i, s in self.shutters.items()])
+
+        i = 0
+        while i < loops:
+            # Set shutters in the state of the loop early enough for them to be done at its end. States are given, rather than switches, so that skipping a late alternation does not swap the states of the following ones.
+            yield t + (i + 1) * wait - lead, self.set_states, (dict([(k, states[k] != (i % 2 == 0)) for k in states.keys()]), False, i)
+            i += 1
+
+        # Release the held motors
+        yield t + loops * wait, self.motion.hold, (self.shutters.values(), False)
+
+    def run_sequence(self, sequence, t=None, late='fire'):
+        """
+        Run a Sequence, starting at time <t> (see TimeKeeper.add; now if None). <late> tells what to do with late transitions (see TimeKeeper).
 
-            # Update progress on GUI
-            if self.gui is not None:
-                for j in np.arange(0, wait, self.gui.update_frequency):
-                    self.todo.add(t + i * wait + j, self.gui.update_shuttering_progress, (i, j))
+        The Sequence is checked first (see PAWS.check_sequence). Transitions are started early enough for the shutters to be done on time, all by the delay of the slowest shutter of the sequence, so that the ones at the same time are moved in one burst (see PAWS.get_lead).
+        """
+        self.check_sequence(sequence)
+        delays = dict.fromkeys(sequence.channels.keys(), self.get_lead(sequence.channels.keys()))
+        t = self.clock.time() if t is None else t
+        self.start_protocol(None, [self.shutters[i] for i in sequence.channels.keys()])
+        self.add_run(self.sequence_timeline(sequence, t, delays), late)
+
+    def get_lead(self, ids):
+        """Return the time (in seconds) a switch of the shutters <ids> is started before it is due: the delay of the slowest one (see Shutter.delay). Shutters switched together are moved in one burst, so that they are done together, and their delays are measured in that burst (see PAWS.calibrate)."""
+        return max([self.shutters[i].delay for i in ids]) if len(ids) > 0 else 0
+
+    def check_sequence(self, sequence):
+        """Check <sequence> against the shutters and the time each one takes to switch (see Shutter.delay), and raise a ValueError if it uses missing shutters or has conflicting moves. Return the delays, as {shutter id: delay}."""
+        missing = [i for i in sequence.channels.keys() if self.shutters is None or i not in self.shutters]
+        if len(missing) > 0:
+            raise ValueError("There are no shutters {0}.".format(missing))
+        delays = dict([(i, self.shutters[i].delay) for i in sequence.channels.keys()])
+        sequence.check(delays)
+        return delays
+
+    def queue_shutter(self, loops, wait):
+        """Add a shuttering (see PAWS.shutter) to the queue of protocols (see PAWS.run_queue)."""
+        self.protocols.append(('shutter', loops, wait))
+        self.changed()
+
+    def queue_sequence(self, sequence):
+        """Add a Sequence to the queue of protocols (see PAWS.run_queue), after checking it (see PAWS.check_sequence)."""
+        self.check_sequence(sequence)
+        self.protocols.append(('sequence', sequence))
+        self.changed()
+
+    def run_queue(self, t=None, late='fire'):
+        """
+        Run the queued protocols one after the other, starting at time <t> (see TimeKeeper.add; now if None), with the <late> policy (see TimeKeeper).
 
-        # Mark the end of shuttering on GUI
-        if self.gui is not None:
-            self.todo.add(t + loops * wait, self.gui.update_shuttering_progress, (loops, wait))
+        Each protocol starts at the exact time the previous one ends, on the same timeline, so that there is no gap between them. Protocols queued while the queue runs are run too, if they are queued before the end of the last one. The Run of the queue is kept in self.queue_run.
+        """
+        if self.queue_run is not None and self.queue_run.finished is False:
+            return
+        t = self.clock.time() if t is None else t
+        self.queue_run = self.add_run(self.queue_timeline(t), late)
+        self.changed()
+
+    def clear_queue(self):
+        """Remove the protocols waiting in the queue. The one in progress goes on."""
+        self.protocols.clear()
+        self.changed()
+
+    def get_queue(self):
+        """Return whether the queue is running, and the protocols waiting in it, as ('shutter', loops, wait) and ('sequence', Sequence) tuples."""
+        return self.queue_run is not None and self.queue_run.finished is False, list(self.protocols)
+
+    def queue_timeline(self, t):
+        """Yield the events of the queued protocols, in chronological order, each one starting at the end of the previous one, from time <t>."""
+        # States the shutters will be in at the start of each protocol
+        states = dict([(i, s.next_state) for i, s in self.shutters.items()])
+        while len(self.protocols) > 0:
+            protocol = self.protocols.popleft()
+            if protocol[0] == 'shutter':
+                loops, wait = protocol[1:]
+                yield t, self.start_queued, ((t, loops, wait), self.shutters.values())
+                for event in self.shuttering_timeline(t, loops, wait, dict(states)):
+                    yield event
+                states = dict([(i, state != (loops % 2 == 1)) for i, state in states.items()])
+                t += loops * wait
+            else:
+                sequence = protocol[1]
+                delays = dict.fromkeys(sequence.channels.keys(), self.get_lead(sequence.channels.keys()))
+                yield t, self.start_protocol, (None, [self.shutters[i] for i in sequence.channels.keys()])
+                for event in self.sequence_timeline(sequence, t, delays):
+                    yield event
+                for i, block in sequence.channels.items():
+                    if block.get_last_state() is not None:
+                        states[i] = block.get_last_state()
+                t += sequence.get_duration()
+
+        # The queue is done once this last event is: tell it.
+        yield t, self.changed, None
+
+    def add_run(self, timeline, late='fire'):
+        """Schedule <timeline> on the TimeKeeper with the <late> policy, as one of the runs stopped, paused and resumed together. Return its Run."""
+        run = self.todo.add_timeline(timeline, late)
+        if self.paused is not None:
+            run.pause()
+        self.runs = [r for r in self.runs if r.finished is False] + [run]
+        return run
+
+    def sequence_timeline(self, sequence, t, delays):
+        """Yield the events of <sequence> (see PAWS.run_sequence) started at time <t>, in chronological order."""
+        import numpy as np
+        for times, ids, states, loops in sequence.compile(delays):
+            # Set the shutters with transitions at the same time together
+            times = np.round(times, 6)
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(times)) + 1))
+            ends = np.append(starts[1:], len(times))
+            for a, b in zip(starts, ends):
+                yield t + times[a], self.set_states, (dict(zip(ids[a:b].tolist(), states[a:b].tolist())), False, dict(zip(ids[a:b].tolist(), loops[a:b].tolist())))
+
+        # Release the held motors
+        yield t + sequence.get_duration(), self.motion.hold, ([self.shutters[i] for i in sequence.channels.keys()], False)
+
+    def set_states(self, states, wait=True, loop=None):
+        """
+        Set several shutters in the given states at once.
+
+        All the motors are engaged, then all sent to their target, in one burst, and the shutters are done together.
+
+        Arguments:
+            states <dict>: {shutter id: state} (True = Closed / False = Opened). Shutters already in the given state, or switching to it, are left alone.
+            wait <bool>: whether to wait for all the shutters to be done.
+            loop <int, dict>: loop of the protocol the move belongs to, or loops by shutter id (see Move). Defaults to None.
+
+        Returns the timing report of the move (see Move.report) if wait is True, the Move otherwise. If wait is True and the move failed, its error is raised (see Move.error).
+        """
+        shutters = [self.shutters[i] for i, state in states.items() if self.shutters[i].next_state != state]
+        move = self.motion.switch(shutters, loop)
+        if wait:
+            move.wait()
+            if move.error is not None:
+                raise move.error
+            return move.report()
+        return move
+
+    def switch(self, ids, wait=True, loop=None):
+        """Switch the shutters <ids> at once, from the state they are switching to if they are switching. See PAWS.set_states."""
+        return self.set_states(dict([(i, not self.shutters[i].next_state) for i in ids]), wait, loop)
+
+    def get_timings(self):
+        """
+        Return the summaries of the timings of PAWS, as a dict (see Timings.summaries):
+            scheduler: lateness and duration of the events of the TimeKeeper
+            moves: latency, skew and duration of the moves
+            shutters: duration of the engage, move and disengage steps of each shutter's switches, by shutter id
+            runs: reports of the last shutterings and sequences, including their overruns (see Run.report)
+        """
+        shutters = dict()
+        if self.shutters is not None:
+            shutters = dict([(i, s.timings.summaries()) for i, s in self.shutters.items()])
+        return {'scheduler': self.todo.timings.summaries(),
+                'moves': self.motion.timings.summaries(),
+                'shutters': shutters,
+                'runs': [run.report() for run in self.runs]}
+
+    def switch_all(self, wait=True):
+        """Switch all the shutters at once. See PAWS.set_states."""
+        return self.switch(self.shutters.keys(), wait)
+
+    def calibrate(self, repeats=5):
+        """
+        Measure the time each shutter takes to switch, and use it as the shutter's delay.
+
+        All the shutters are switched together 2 * <repeats> times, so that they end in their original state, and the median time between the request and the end of each shutter's move is kept. They are measured in one burst, as the scheduled switches are done (see PAWS.get_lead). Return the delays, as {shutter id: delay}.
+        """
+        durations = dict([(i, list()) for i in self.shutters.keys()])
+        for k in range(2 * repeats):
+            move = self.switch_all(wait=False)
+            move.wait()
+            if move.error is not None:
+                raise move.error
+            for i, t in move.done.items():
+                durations[i].append(t - move.requested)
+        for i, d in durations.items():
+            self.shutters[i].delay = sorted(d)[len(d) // 2]
+        return dict([(i, s.delay) for i, s in self.shutters.items()])
+
+    def tune(self, ids=None, steps=5, repeats=3, margin=0.8):
+        """
+        Find the fastest motion profile of each shutter that does not make its motor skip steps, and keep it in the shutter's settings (see Shutter.tune).
+
+        Velocities and accelerations are tried in <steps> steps up to the highest ones the board allows. The shutters <ids> (all if None) are tuned one after the other, and must not be moving, held or running a protocol. As the tuned shutters switch in another time, the delays of the shutters are then measured again (see PAWS.calibrate), <repeats> times. Return the profiles kept, as {shutter id: (velocity, acceleration, duration)}, None for the shutters that skipped steps at every profile.
+        """
+        if any([r.finished is False for r in self.runs]) or self.clock.activities > 0:
+            raise RuntimeError('Shutters cannot be tuned while they are moving or running a protocol.')
+        ids = sorted(self.shutters.keys()) if ids is None else ids
+        profiles = dict()
+        for i in ids:
+            shutter = self.shutters[i]
+            velocity, acceleration = shutter.hardware.getVelocityMax(shutter.motor), shutter.hardware.getAccelerationMax(shutter.motor)
+            fractions = [(k + 1) / steps for k in range(steps)]
+            profiles[i] = shutter.tune([velocity * f for f in fractions], [acceleration * f for f in fractions], repeats, margin)
+            logger.info('Shutter %s tuned to: %s', i, profiles[i])
+        logger.info('Shutters calibrated again: %s', self.calibrate(repeats))
+        return profiles
+
+    def dry_run(self, loops, wait):
+        """
+        Run a shuttering (see PAWS.shutter) on simulated hardware with a virtual clock, as fast as possible, to check it before running it for real.
+
+        The shutters are copied with their settings and states, and the real ones are left alone. Return the Report of the run.
+        """
+        clock = VirtualClock()
+        shutters = dict([(i, s.get_settings()) for i, s in self.shutters.items()])
+        motors = max(shutters.keys()) + 1 if len(shutters) > 0 else 0
+        dry = PAWS(shutters=shutters, precision=self.todo.precision, hardware=SimulatedHardware(motors=motors, clock=clock), clock=clock)
+        try:
+            report = Report(dry.shutters, clock.now())
+            dry.motion.observers.append(report.record)
+            dry.shutter(loops, wait)
+            report.end = report.start + loops * wait
+            dry.wait()
+        finally:
+            dry.close()
+        return report
+
+    def wait(self, interval=0.01):
+        """Wait for the TimeKeeper to have nothing left to do, and for the moves to be done, looking every <interval> seconds (of real time)."""
+        done = False
+        while done is False:
+            time.sleep(interval)
+            with self.todo.condition:
+                done = self.todo.pending() == 0 and self.clock.activities == 0
 
     def stop_shutter(self, *args):
-        """Stop the shutter."""
-        self.todo.stop()
-        self.todo = TimeKeeper(self.todo.precision)
+        """Stop the shutterings and sequences, without waiting for the moves in progress. Other events of the TimeKeeper are kept."""
+        self.shuttering = None
+        self.paused = None
+        for run in self.runs:
+            run.cancel()
+        self.runs = list()
+        if self.shutters is not None:
+            self.motion.hold(self.shutters.values(), False)
+        self.changed()
+
+    def pause_shutter(self):
+        """Pause the shutterings and sequences, leaving the shutters as they are."""
+        if self.paused is None:
+            self.paused = self.clock.time()
+            for run in self.runs:
+                run.pause()
+            self.changed()
+
+    def resume_shutter(self):
+        """Resume the paused shutterings and sequences, shifting what is left of them by the time they were paused for."""
+        if self.paused is not None:
+            if self.shuttering is not None:
+                t, loops, wait = self.shuttering
+                self.shuttering = (t + self.clock.time() - self.paused, loops, wait)
+            self.paused = None
+            for run in self.runs:
+                run.resume()
+            self.changed()
 
     def load_settings(self, f):
         """Load settings from a file."""
@@ -572,9 +2520,15 @@ class PAWS(object):
     def __del__(self):
         """Kill the object clean."""
         self.todo.stop()
-        if self.shutters is not None:
-            for s in self.shutters.values():
-                s.stop()
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if self.metrics is not None:
+            self.metrics.stop()
+            self.metrics = None
+        self.motion.stop()
+        if self.log is not None:
+            self.log.close()
         if self.hardware is not None:
             self.hardware.stop()
         if self.gui is not None:
@@ -585,12 +2539,45 @@ class PAWS(object):
     close = __del__
 
 if __name__ == "__main__":
-    shutters = {
-        0: {'step': 1.8, 'angle': 30, 'direction': False, 'state': True},
-        1: {'step': 1.8, 'angle': 30, 'direction': False, 'state': True}
-    }
-    # P = PAWS(shutters=shutters, precision=0.1)
-    # P.settings = 'paws.conf'
-    P = PAWS(settings="paws.conf")
-    P.start_gui()
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description="Programmable Alternating/Waiting Shutter.")
+    parser.add_argument('--settings', default="paws.conf", help="settings file, created if it does not exist")
+    parser.add_argument('--headless', action='store_true', help="do not start the graphical interface")
+    parser.add_argument('--run', help="Sequence (JSON file) to run, before exiting when headless")
+    parser.add_argument('--late', choices=Run.policies, default='fire', help="what to do with the late transitions of the sequence (see TimeKeeper)")
+    parser.add_argument('--listen', help="serve the control socket at this path, or at this port on localhost (see control.py)")
+    parser.add_argument('--metrics', help="serve the metrics over HTTP at this port, or host:port (see metrics.py)")
+    parser.add_argument('--log', help="file to record the transitions of the shutters in (see TransitionLog)")
+    parser.add_argument('--simulate', action='store_true', help="use a simulated board instead of the Phidgets one")
+    parser.add_argument('--boards', type=int, nargs='+', help="serial numbers of the boards to use, in the order of the shutter ids (see Pool). Defaults to all the attached boards.")
+    parser.add_argument('--tune', action='store_true', help="tune the motion profile of the shutters, and save it in the settings, before anything else (see PAWS.tune)")
+    parser.add_argument('--isolate', action='store_true', help="run the shutters in a separate, high priority process (see process.py)")
+    args = parser.parse_args()
+
+    if args.isolate:
+        from process import PAWSProcess
+        P = PAWSProcess(settings=args.settings, simulate=args.simulate, boards=args.boards)
+    else:
+        P = PAWS(settings=args.settings, hardware=Pool.open(args.boards, args.simulate) if args.simulate or args.boards is not None else None)
+    if args.tune:
+        P.tune()
+    if args.log is not None:
+        P.start_log(args.log)
+    if args.listen is not None:
+        P.start_server(args.listen)
+    if args.metrics is not None:
+        P.start_metrics(args.metrics)
+    if args.run is not None:
+        P.run_sequence(Sequence.load(args.run), late=args.late)
+    if args.headless:
+        try:
+            P.wait()
+            if args.run is None or args.listen is not None:
+                # Nothing to do but to stay up until interrupted
+                while True:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    else:
+        P.start_gui()
     P.close()
@@ -0,0 +1,470 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""
+PAWS running in a process of its own, isolated from the GUI.
+
+The TimeKeeper, the MotionController and the hardware share the GIL with everything else in their process: a busy GUI delays the shutters. PAWSProcess runs them in a separate process, with a higher priority and its own CPUs where the OS allows it, and controls it through a command queue. The states of the shutters, the shuttering in progress and the queue of protocols are published in a shared memory block (see SharedState), so that the GUI reads them without waiting for the other process. PAWSProcess can be used in place of a PAWS by the GUI.
+
+@author: Corentin Moevus cjm2206@columbia.edu
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function
+import os
+import signal
+import logging
+import threading
+import multiprocessing
+from math import isnan
+from Queue import Full
+from paws import PAWS, Clock, Pool
+
+logger = logging.getLogger('paws')
+
+
+class SharedState(object):
+    """
+    States of the shutters and shuttering of a PAWS, in shared memory, written by the process running PAWS and read by the others without locks.
+
+    The block holds doubles: a version, the start, loops and wait of the shuttering (NaN if there is none), then the state of each motor (1 for closed, 0 for open, NaN if there is no shutter), then the queue of protocols: whether it is running, the number of protocols waiting in it, and three values for each of the first ones, (0, loops, wait) for a shuttering and (1, duration, 0) for a sequence. The version is odd while the shuttering or the queue is written, so that readers can tell when to read them again.
+
+    Arguments:
+        block <multiprocessing.RawArray>: shared memory block, from SharedState.allocate
+    """
+
+    motors = 64
+    protocols = 256
+
+    def __init__(self, block):
+        """Use the shared memory <block>."""
+        self.block = block
+        self.lock = threading.Lock()
+
+    @classmethod
+    def allocate(cls):
+        """Return a new shared memory block, with no shuttering nor shutters."""
+        return multiprocessing.RawArray(b'd', [0] + [float('nan')] * (3 + cls.motors) + [0] * (2 + 3 * cls.protocols))
+
+    def write(self, start, values):
+        """Write the <values> in the block from index <start>, as one version."""
+        with self.lock:
+            self.block[0] += 1
+            self.block[start:start + len(values)] = values
+            self.block[0] += 1
+
+    def read(self, start, end):
+        """Return the values of the block from index <start> to <end>, as written together."""
+        while True:
+            version = self.block[0]
+            if version % 2 == 0:
+                values = self.block[start:end]
+                if self.block[0] == version:
+                    return values
+
+    def set_shuttering(self, shuttering):
+        """Publish the <shuttering> (see PAWS.shuttering)."""
+        self.write(1, list(shuttering) if shuttering is not None else [float('nan')] * 3)
+
+    def get_shuttering(self):
+        """Return the shuttering (see PAWS.shuttering)."""
+        t, loops, wait = self.read(1, 4)
+        return None if isnan(t) else (t, int(loops), wait)
+
+    def set_queue(self, running, protocols):
+        """Publish the queue of protocols (see PAWS.get_queue): whether it is <running>, and the <protocols> waiting in it. Only the first SharedState.protocols ones are kept."""
+        values = [float(running), len(protocols)]
+        for protocol in list(protocols)[:self.protocols]:
+            values += [0, protocol[1], protocol[2]] if protocol[0] == 'shutter' else [1, protocol[1].get_duration(), 0]
+        self.write(4 + self.motors, values)
+
+    def get_queue(self):
+        """Return whether the queue is running, and the protocols waiting in it, as ('shutter', loops, wait) and ('sequence', RemoteSequence) tuples."""
+        start = 4 + self.motors
+        values = self.read(start, start + 2 + 3 * self.protocols)
+        protocols = list()
+        for k in range(min(int(values[1]), self.protocols)):
+            kind, a, b = values[2 + 3 * k:5 + 3 * k]
+            protocols.append(('shutter', int(a), b) if kind == 0 else ('sequence', RemoteSequence(a)))
+        return values[0] == 1, protocols
+
+    def set_state(self, i, state):
+        """Publish the <state> of shutter <i>, None if there is no shutter <i>."""
+        self.block[4 + i] = float('nan') if state is None else float(state)
+
+    def set_shutters(self, shutters):
+        """Publish the states of the <shutters> (dict of Shutter by id, or None), and that there are no others."""
+        with self.lock:
+            for i in range(self.motors):
+                self.set_state(i, shutters[i].state if shutters is not None and i in shutters else None)
+
+    def get_state(self, i):
+        """Return the state of shutter <i>, None if there is no such shutter."""
+        state = self.block[4 + i]
+        return None if isnan(state) else bool(state)
+
+
+class RemoteSequence(object):
+    """Sequence waiting in the queue of a PAWSProcess, as seen from the parent process, which only knows its duration."""
+
+    def __init__(self, duration):
+        """Keep the duration."""
+        self.duration = duration
+
+    def get_duration(self):
+        """Return the duration (in seconds) of the sequence."""
+        return self.duration
+
+
+def raise_priority(niceness=-10, cpus=None):
+    """
+    Raise the priority of the current process, and pin it to some CPUs, as far as the OS and the user's rights allow it.
+
+    psutil is used if it is installed, and os.nice otherwise (without CPU affinity).
+
+    Arguments:
+        niceness <int>: niceness to set, from -20 (highest priority) to 19, on Unix. On Windows, the process gets the high priority class. Defaults to -10.
+        cpus <list>: CPUs to run the process on. None to leave it as it is. Defaults to None.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        process = psutil.Process()
+        try:
+            process.nice(psutil.HIGH_PRIORITY_CLASS if os.name == 'nt' else niceness)
+        except psutil.Error as e:
+            logger.warning('Could not raise the priority of the motion process: %s', e)
+        if cpus is not None:
+            try:
+                process.cpu_affinity(cpus)
+            except (AttributeError, psutil.Error) as e:
+                logger.warning('Could not set the CPU affinity of the motion process: %s', e)
+    elif hasattr(os, 'nice'):
+        try:
+            os.nice(niceness - os.nice(0))
+        except OSError as e:
+            logger.warning('Could not raise the priority of the motion process: %s', e)
+        if cpus is not None:
+            logger.warning('Install psutil to set the CPU affinity of the motion process.')
+
+
+def serve(options, block, commands, replies, events):
+    """Run a PAWS and do the <commands> sent by a PAWSProcess. Runs in the motion process."""
+    # Interruptions are for the parent process, which stops this one.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise_priority(options['niceness'], options['cpus'])
+
+    hardware = Pool.open(options['boards'], options['simulate']) if options['simulate'] or options['boards'] is not None else None
+    paws = PAWS(precision=options['precision'], hardware=hardware)
+    state = SharedState(block)
+
+    def transition(shutter, move):
+        """Publish the transition of <shutter>."""
+        state.set_state(shutter.id, shutter.state)
+        try:
+            events.put_nowait((shutter.id, shutter.state))
+        except Full:
+            pass
+    paws.motion.observers.append(transition)
+
+    publishing = threading.Lock()
+
+    def changed():
+        """Publish the protocol in progress and the queue, as they are once the last change is done."""
+        with publishing:
+            state.set_shuttering(paws.shuttering)
+            state.set_queue(*paws.get_queue())
+    paws.observers.append(changed)
+    replies.put(paws.hardware.getMotorCount() if paws.hardware is not None else None)
+
+    for command, args, replied in iter(commands.get, None):
+        try:
+            if command == 'precision':
+                paws.todo.precision = args[0]
+                continue
+            elif command == 'shutter_settings':
+                reply = dict([(i, s.get_settings()) for i, s in paws.shutters.items()]) if paws.shutters is not None else None
+            else:
+                reply = getattr(paws, command)(*args)
+        except Exception as e:
+            # Raised in the parent process if it waits for the reply
+            if replied is False:
+                logger.exception('The motion process failed to do %s.', command)
+            reply = e
+        # Publish the states before replying, so that they are the new ones once a move waited for is done.
+        if command in ('setup_shutters', 'calibrate', 'tune', 'set_states', 'switch'):
+            state.set_shutters(paws.shutters)
+        if replied is True:
+            replies.put(reply)
+
+    paws.close()
+    events.put(None)
+
+
+class RemoteShutter(object):
+    """
+    Shutter of a PAWSProcess, as seen from the parent process.
+
+    Its settings (see Shutter.get_settings), such as step, angle and direction, are read as attributes, from the copy the PAWSProcess keeps of the ones of the motion process.
+
+    Arguments:
+        paws <PAWSProcess>: PAWS the shutter is part of
+        ID: ID of the shutter
+        settings <dict>: settings of the shutter (see Shutter.get_settings)
+    """
+
+    def __init__(self, paws, ID, settings):
+        """Keep the settings."""
+        self.paws, self.id, self.settings = paws, ID, dict(settings)
+        self.gui = None
+
+    def __getattr__(self, name):
+        """Return the setting <name> of the shutter."""
+        settings = self.__dict__.get('settings', dict())
+        if name not in settings:
+            raise AttributeError("'RemoteShutter' object has no attribute '{0}'".format(name))
+        return settings[name]
+
+    @property
+    def state(self):
+        """State of the shutter, as published by the motion process."""
+        state = self.paws.state.get_state(self.id)
+        return self.settings['state'] if state is None else state
+
+    def activate(self):
+        """Ask for the shutter to be switched, without waiting for it to be done."""
+        self.paws.switch([self.id], wait=False)
+
+    def get_settings(self):
+        """Return the settings of the shutter (see Shutter.get_settings)."""
+        settings = dict(self.settings)
+        settings['state'] = self.state
+        return settings
+
+
+class RemoteTimeKeeper(object):
+    """TimeKeeper of a PAWSProcess, as seen from the parent process, for setting its precision."""
+
+    def __init__(self, paws, precision):
+        """Keep the precision."""
+        self.paws, self._precision = paws, precision
+
+    @property
+    def precision(self):
+        """Precision of the TimeKeeper (see TimeKeeper)."""
+        return self._precision
+
+    @precision.setter
+    def precision(self, precision):
+        self._precision = precision
+        self.paws.send('precision', precision)
+
+
+class RemoteBoard(object):
+    """Board of a PAWSProcess, as seen from the parent process."""
+
+    def __init__(self, motors):
+        """Keep the number of motors."""
+        self.motors = motors
+
+    def getMotorCount(self):
+        """Return the number of motors of the board."""
+        return self.motors
+
+
+class PAWSProcess(object):
+    """
+    PAWS running in a separate process (see the module's documentation), with the interface of PAWS used by the GUI, the command line and scripts.
+
+    Arguments:
+        settings <str>: see PAWS
+        shutters <dict>: see PAWS
+        precision <float>: see PAWS
+        simulate <bool>: whether to use a SimulatedHardware instead of the Phidgets board. Defaults to False.
+        boards <list>: serial numbers of the boards to use (see Pool.open). Defaults to None, for all the attached boards.
+        niceness <int>: priority of the motion process (see raise_priority). Defaults to -10.
+        cpus <list>: CPUs to run the motion process on. Defaults to None, for any.
+    """
+
+    def __init__(self, settings=None, shutters=None, precision=0.5, simulate=False, niceness=-10, cpus=None, boards=None):
+        """Start the motion process."""
+        self.settings = None
+        self.shutters = None
+        self.gui = None
+        self.paused = None
+        self.clock = Clock()
+        self.lock = threading.Lock()
+        self.todo = RemoteTimeKeeper(self, precision)
+        self.state = SharedState(SharedState.allocate())
+
+        # Start the process, and wait for it to be ready.
+        self.commands, self.replies, self.events = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Queue(1000)
+        options = {'precision': precision, 'simulate': simulate, 'niceness': niceness, 'cpus': cpus, 'boards': boards}
+        self.process = multiprocessing.Process(target=serve, args=(options, self.state.block, self.commands, self.replies, self.events))
+        self.process.daemon = True
+        self.process.start()
+        motors = self.replies.get(True, 30)
+        self.hardware = RemoteBoard(motors) if motors is not None else None
+
+        # Tell the GUI about the transitions
+        self.listener = threading.Thread(target=self.listen)
+        self.listener.daemon = True
+        self.listener.start()
+
+        # Load a configuration
+        if settings is not None:
+            self.settings = settings
+            if os.path.isfile(settings):
+                self.load_settings(settings)
+        elif shutters is not None:
+            self.setup_shutters(shutters)
+
+    def send(self, command, *args):
+        """Send <command> (a method of PAWS) to the motion process, with its <args>, without waiting for it to be done."""
+        self.commands.put((command, args, False))
+
+    def call(self, command, *args):
+        """Send <command> (a method of PAWS) to the motion process, with its <args>, and return its result once it is done. Its exceptions are raised here."""
+        with self.lock:
+            self.commands.put((command, args, True))
+            reply = self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def listen(self):
+        """Tell the GUI about the transitions of the shutters, until the motion process is done."""
+        for i, state in iter(self.events.get, None):
+            shutter = self.shutters.get(i) if self.shutters is not None else None
+            if shutter is not None and shutter.gui is not None:
+                shutter.gui.shutter_switched(shutter)
+
+    @property
+    def shuttering(self):
+        """Shuttering in progress (see PAWS.shuttering)."""
+        return self.state.get_shuttering()
+
+    def setup_shutters(self, shutters):
+        """Setup shutters (see PAWS.setup_shutters)."""
+        self.call('setup_shutters', shutters)
+        self.shutters = dict([(i, RemoteShutter(self, i, s)) for i, s in shutters.items()]) if shutters is not None else None
+        self.update_shutters()
+
+    def update_shutters(self):
+        """Copy the settings of the shutters from the motion process, such as the ones set by calibrate and tune."""
+        settings = self.call('shutter_settings')
+        if settings is None or self.shutters is None:
+            return
+        for i, s in settings.items():
+            if i in self.shutters:
+                self.shutters[i].settings = s
+
+    def shutter(self, loops, wait, late='fire'):
+        """See PAWS.shutter."""
+        self.call('shutter', loops, wait, late)
+
+    def stop_shutter(self, *args):
+        """See PAWS.stop_shutter."""
+        self.call('stop_shutter')
+        self.paused = None
+
+    def pause_shutter(self):
+        """See PAWS.pause_shutter."""
+        self.call('pause_shutter')
+        if self.paused is None:
+            self.paused = self.clock.time()
+
+    def resume_shutter(self):
+        """See PAWS.resume_shutter."""
+        self.call('resume_shutter')
+        self.paused = None
+
+    def set_states(self, states, wait=True, loop=None):
+        """See PAWS.set_states. The report of the move is returned if wait is True, None otherwise."""
+        if wait is True:
+            return self.call('set_states', states, wait, loop)
+        self.send('set_states', states, wait, loop)
+
+    def switch(self, ids, wait=True, loop=None):
+        """See PAWS.switch. The shutters are switched from the state they are switching to in the motion process. The report of the move is returned if wait is True, None otherwise."""
+        if wait is True:
+            return self.call('switch', list(ids), wait, loop)
+        self.send('switch', list(ids), wait, loop)
+
+    def switch_all(self, wait=True):
+        """See PAWS.switch_all."""
+        return self.switch(self.shutters.keys(), wait)
+
+    def calibrate(self, repeats=5):
+        """See PAWS.calibrate."""
+        delays = self.call('calibrate', repeats)
+        self.update_shutters()
+        return delays
+
+    def tune(self, ids=None, steps=5, repeats=3, margin=0.8):
+        """See PAWS.tune."""
+        profiles = self.call('tune', ids, steps, repeats, margin)
+        self.update_shutters()
+        return profiles
+
+    def get_timings(self):
+        """See PAWS.get_timings."""
+        return self.call('get_timings')
+
+    def run_sequence(self, sequence, t=None, late='fire'):
+        """See PAWS.run_sequence."""
+        self.call('run_sequence', sequence, t, late)
+
+    def queue_shutter(self, loops, wait):
+        """See PAWS.queue_shutter."""
+        self.call('queue_shutter', loops, wait)
+
+    def queue_sequence(self, sequence):
+        """See PAWS.queue_sequence."""
+        self.call('queue_sequence', sequence)
+
+    def run_queue(self, t=None, late='fire'):
+        """See PAWS.run_queue."""
+        self.call('run_queue', t, late)
+
+    def clear_queue(self):
+        """See PAWS.clear_queue."""
+        self.call('clear_queue')
+
+    def get_queue(self):
+        """See PAWS.get_queue. Sequences are RemoteSequence objects."""
+        return self.state.get_queue()
+
+    def wait(self, interval=0.01):
+        """See PAWS.wait."""
+        self.call('wait', interval)
+
+    def start_log(self, f):
+        """See PAWS.start_log. The log is written by the motion process."""
+        self.call('start_log', f)
+
+    def start_metrics(self, address):
+        """See PAWS.start_metrics. The metrics are served by the motion process."""
+        self.call('start_metrics', address)
+
+    def start_server(self, address):
+        """See PAWS.start_server. The control socket is served by the motion process."""
+        self.call('start_server', address)
+
+    # Same as PAWS, on the state published by the motion process
+    get_progress = PAWS.get_progress.__func__
+    start_gui = PAWS.start_gui.__func__
+    load_settings = PAWS.load_settings.__func__
+    save_settings = PAWS.save_settings.__func__
+
+    def __del__(self):
+        """Stop the motion process, and save the settings."""
+        if self.gui is not None:
+            self.gui.close()
+        if self.process.is_alive():
+            self.commands.put(None)
+            self.process.join(5)
+        if self.settings is not None:
+            self.save_settings()
+
+    close = __del__